@@ -15,9 +15,24 @@ index = {"Config": "00_learner.ipynb",
          "show": "02_data.ipynb",
          "preprocess_mask": "02_data.ipynb",
          "DeformationField": "02_data.ipynb",
+         "TiffRegionReader": "02_data.ipynb",
+         "open_region_reader": "02_data.ipynb",
+         "REGION_READERS": "02_data.ipynb",
+         "VOLUME_READERS": "02_data.ipynb",
+         "ImageCache": "02_data.ipynb",
+         "MASK_CACHE": "02_data.ipynb",
+         "LazyImage": "02_data.ipynb",
+         "ThumbnailCache": "02_data.ipynb",
          "BaseDataset": "02_data.ipynb",
+         "CenterSampler": "02_data.ipynb",
          "RandomTileDataset": "02_data.ipynb",
+         "batch_augment": "02_data.ipynb",
+         "BatchAugmentation": "02_data.ipynb",
+         "HardExampleSampler": "02_data.ipynb",
+         "ShardDataset": "02_data.ipynb",
          "TileDataset": "02_data.ipynb",
+         "worker_init_fn": "02_data.ipynb",
+         "PersistentDL": "02_data.ipynb",
          "Dice": "03_metrics.ipynb",
          "Iou": "03_metrics.ipynb",
          "Recorder.plot_metrics": "03_metrics.ipynb",
@@ -1,13 +1,19 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/02_data.ipynb (unless otherwise specified).
 
-__all__ = ['show', 'preprocess_mask', 'DeformationField', 'BaseDataset', 'RandomTileDataset', 'TileDataset']
+__all__ = ['show', 'preprocess_mask', 'DeformationField', 'TiffRegionReader', 'open_region_reader', 'REGION_READERS',
+           'VOLUME_READERS', 'ImageCache', 'MASK_CACHE', 'LazyImage', 'ThumbnailCache', 'BaseDataset', 'CenterSampler',
+           'RandomTileDataset', 'batch_augment', 'BatchAugmentation', 'HardExampleSampler', 'ShardDataset',
+           'TileDataset', 'worker_init_fn', 'PersistentDL']
 
 # Cell
-import os, zarr, cv2, imageio, shutil, random
+import os, zarr, cv2, imageio, shutil, random, hashlib, json, functools, math, itertools
 
-import numpy as np
+import numpy as np, tifffile
 
+from collections import OrderedDict
 from matplotlib.patches import Rectangle
+from PIL import Image
+from scipy import ndimage
 from skimage.measure import label
 from skimage.color import label2rgb
 
@@ -16,7 +22,8 @@ import albumentations.augmentations.functional as AF
 from albumentations.pytorch.transforms import ToTensorV2
 
 import torch, torch.nn as nn, torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, IterableDataset, get_worker_info
+from torch.utils.data.dataloader import _MultiProcessingDataLoaderIter
 
 from fastai.vision.all import *
 from fastcore.all import *
@@ -150,30 +157,52 @@ def preprocess_mask(clabels=None, instlabels=None, ignore=None, remove_overlap=T
             nextInstance = 1
             for c in classes:
                 #comps2, nInstances2 = ndimage.measurements.label(clabels == c)
-                nInstances, comps = cv2.connectedComponents((clabels[:] == c).astype('uint8'), connectivity=4)
-                nInstances -=1
+                if n_dims==3:
+                    comps, nInstances = ndimage.label(clabels[:] == c)
+                else:
+                    nInstances, comps = cv2.connectedComponents((clabels[:] == c).astype('uint8'), connectivity=4)
+                    nInstances -=1
                 instlabels[comps > 0] = comps[comps > 0] + nextInstance
                 nextInstance += nInstances
 
+        # Bounding boxes of all instances for local ridge generation
+        instlabels = np.asarray(instlabels[:])
+        objects = ndimage.find_objects(instlabels.astype(np.intp, copy=False))
+        kernel = np.ones((3,) * n_dims)
         for c in classes:
             # Extract all instance labels of class c
-            il = (instlabels * (clabels[:] == c)).astype(np.int16)
-            instances = np.unique(il)[1:]
+            il = instlabels * (clabels[:] == c)
 
             # Generate background ridges between touching instances
             # of that class, avoid overlapping instances
-            dil = cv2.morphologyEx(il, cv2.MORPH_CLOSE, kernel=np.ones((3,) * n_dims))
-            overlap_cand = np.unique(np.where(dil!=il, dil, 0))
+            # cv2 morphology does not support int32 labels, int16 overflows for >32767 instances
+            if n_dims==3:
+                dil = ndimage.grey_closing(il, footprint=kernel)
+            else:
+                morph_dtype = np.int16 if il.max() < np.iinfo(np.int16).max else np.float64
+                dil = cv2.morphologyEx(il.astype(morph_dtype), cv2.MORPH_CLOSE, kernel=kernel)
+            overlap_cand = np.unique(np.where(dil!=il, dil, 0)).astype(instlabels.dtype)
             labels[np.isin(il, overlap_cand, invert=True)] = c
 
+            # Add candidates one by one, only dilating within their (padded) bounding box
             for instance in overlap_cand[1:]:
-                objectMaskDil = cv2.dilate((labels == c).astype('uint8'), kernel=np.ones((3,) * n_dims),iterations = 1)
-                labels[(instlabels == instance) & (objectMaskDil == 0)] = c
+                sl = tuple(slice(max(s.start-1, 0), s.stop+1) for s in objects[instance-1])
+                if n_dims==3: objectMaskDil = ndimage.binary_dilation(labels[sl] == c, structure=kernel)
+                else: objectMaskDil = cv2.dilate((labels[sl] == c).astype('uint8'), kernel=kernel, iterations = 1)
+                labels[sl][(instlabels[sl] == instance) & (objectMaskDil == 0)] = c
     else:
         labels = clabels
 
     return labels#.astype(np.int32)
 
+# Cell
+@functools.lru_cache(maxsize=16)
+def _grid_range(shape, scale):
+    "Read-only coordinate ranges of the base grid for `shape` and `scale`"
+    grid_range = [np.linspace(-(d*scale)/2, ((d*scale)/2)-1, d) for d in shape]
+    for r in grid_range: r.flags.writeable = False
+    return grid_range
+
 # Cell
 # adapted from Falk, Thorsten, et al. "U-Net: deep learning for cell counting, detection, and morphometry." Nature methods 16.1 (2019): 67-70.
 class DeformationField:
@@ -185,17 +214,18 @@ class DeformationField:
         if random.random()<p_scale and sum(scale_range)!=0:
             self.scale = random.uniform(*np.array(scale_range)*scale)
 
-        grid_range = [np.linspace(-(d*self.scale)/2, ((d*self.scale)/2)-1, d) for d in shape]
-        self.deformationField = np.meshgrid(*grid_range)[::-1]
+        # Flip and rotation are composed to one linear transform of the (cached) base grid
+        self.matrix = np.eye(len(shape))
+
+    @property
+    def deformationField(self):
+        return list(self.get())
 
     def rotate(self, theta=0):
-        "Rotate deformation field"
-        self.deformationField = [
-                self.deformationField[0] * np.cos(theta)
-                + self.deformationField[1] * np.sin(theta),
-                -self.deformationField[0] * np.sin(theta)
-                + self.deformationField[1] * np.cos(theta),
-            ]
+        "Rotate deformation field (in the image plane, i.e. the last two axes for volumes)"
+        rot = np.eye(len(self.shape))
+        rot[-2:, -2:] = [[np.cos(theta), np.sin(theta)], [-np.sin(theta), np.cos(theta)]]
+        self.matrix = rot @ self.matrix
 
     def add_random_rotation(self, rotation_range_deg, p=0.5):
         'Add random rotation'
@@ -208,27 +238,35 @@ class DeformationField:
 
     def mirror(self, dims):
         "Mirror deformation fild at dims"
-        for d in range(len(self.shape)):
-            if dims[d]:
-                self.deformationField[d] = -self.deformationField[d]
+        flip = np.array([-1. if dims[d] else 1. for d in range(len(self.shape))])
+        self.matrix = flip[:, None] * self.matrix
 
     def add_random_flip(self, p=0.5):
         "Add random flip"
         if (random.random() < p):
-            self.mirror(np.random.choice((True,False),2))
-
-    def get(self, offset=(0, 0), pad=(0, 0)):
-        "Get relevant slice from deformation field"
-        sliceDef = tuple(slice(int(p / 2), int(-p / 2)) if p > 0 else None for p in pad)
-        deform = [d[sliceDef] for d in self.deformationField]
-        return [d + offs for (d, offs) in zip(deform, offset)]
-
+            self.mirror(np.random.choice((True,False),len(self.shape)))
+
+    def get(self, offset=None, pad=None):
+        "Get relevant slice from deformation field as float32 array of shape (n_dims, *outshape)"
+        n = len(self.shape)
+        offset = (0,)*n if offset is None else offset
+        pad = (0,)*n if pad is None else pad
+        sliceDef = tuple(slice(int(p / 2), int(-p / 2)) if p > 0 else slice(None) for p in pad)
+        ranges = [r[s] for r, s in zip(_grid_range(tuple(self.shape), self.scale), sliceDef)]
+        # The grid is separable: coords[i] = matrix[i,0]*rows + matrix[i,1]*cols + offset[i] (outer sum)
+        coords = np.empty((n, *[len(r) for r in ranges]), dtype='float32')
+        for i in range(n):
+            if n==2:
+                np.add.outer(self.matrix[i,0]*ranges[0], self.matrix[i,1]*ranges[1] + offset[i], out=coords[i])
+            else:
+                coords[i] = offset[i]
+                for j, r in enumerate(ranges): coords[i] += (self.matrix[i,j]*r).reshape([-1 if k==j else 1 for k in range(n)])
+        return coords
 
-    def apply(self, data, offset=(0, 0), pad=(0, 0), order=1):
-        "Apply deformation field to image using interpolation"
+    def apply(self, data, offset=None, pad=None, order=1):
+        "Apply deformation field to image (H,W[,C]) or volume (D,H,W[,C]) using interpolation"
 
-        outshape = tuple(int(s - p) for (s, p) in zip(self.shape, pad))
-        coords = [np.squeeze(d).astype('float32').reshape(*outshape) for d in self.get(offset, pad)]
+        coords = self.get(offset, pad)
 
         # Get slices to avoid loading all data (.zarr files)
         sl = []
@@ -246,114 +284,660 @@ class DeformationField:
             sl.append(slice(cmin, cmax))
 
 
+        if len(coords)==3:
+            # Volumes: spline interpolation with the same border handling as cv2.BORDER_REFLECT
+            data = np.asarray(data[tuple(sl)])
+            if data.ndim==3: return ndimage.map_coordinates(data, coords, order=order, mode='reflect')
+            return np.stack([ndimage.map_coordinates(data[..., c], coords, order=order, mode='reflect')
+                             for c in range(data.shape[-1])], axis=-1)
+
         remap_fn = A.augmentations.functional._maybe_process_in_chunks(
             cv2.remap, map1=coords[1],map2=coords[0], interpolation=order, borderMode=cv2.BORDER_REFLECT
         )
         return remap_fn(data[tuple(sl)])
 
 # Cell
-def _read_img(path, **kwargs):
-    "Read image and normalize to 0-1 range"
+def _read_volume(path, **kwargs):
+    "Read volume (z-stack) from multi-page file in `path`"
+    return tifffile.imread(path) if path.suffix in ['.tif', '.tiff'] else imageio.volread(path, **kwargs)
+
+# Cell
+def _read_img(path, lazy=False, n_dims=2, **kwargs):
+    "Read image (`n_dims=3`: volume) and normalize to 0-1 range, `lazy` returns a `LazyImage` if the format allows region reads"
+    if lazy:
+        img = LazyImage(path, n_dims=n_dims)
+        if img.array is not False: return img
     if path.suffix == '.zarr':
         img = zarr.convenience.open(path.as_posix())
+    elif path.suffix == '.npy':
+        img = np.load(path)
+    elif n_dims==3:
+        img = _read_volume(path, **kwargs)
     else:
         img = imageio.imread(path, **kwargs)
     if img.max()>1.:
         img = img/np.iinfo(img.dtype).max
-    if img.ndim == 2:
-        img = np.expand_dims(img, axis=2)
+    if img.ndim == n_dims:
+        img = np.expand_dims(img, axis=-1)
     return img
 
 # Cell
-def _read_msk(path, n_classes=2, instance_labels=False, **kwargs):
-    "Read image and check classes"
+def _memmap_img(path):
+    "Memory-map uncompressed TIFF (first page) or NPY file in `path`, returns None if not possible"
+    try:
+        if path.suffix == '.npy': return np.load(path, mmap_mode='r')
+        if path.suffix in ['.tif', '.tiff']: return tifffile.memmap(path, page=0, mode='r')
+    except ValueError: pass
+    return None
+
+# Cell
+class TiffRegionReader:
+    "Array-like view of a TIFF page that decodes only the tiles or strips of the requested region"
+    def __init__(self, path, level=0):
+        self.path, self.level = Path(path), level
+        self.tif = tifffile.TiffFile(self.path)
+        # First page (as read by `imageio`) or pyramid level of the first series
+        self.page = self.tif.pages[0] if level==0 else self.tif.series[0].levels[level].keyframe
+        planes, depth, h, w, samples = self.page.shaped
+        if depth!=1: raise ValueError('Volumetric TIFF pages are not supported')
+        self.shape, self.dtype = (h, w, planes*samples), self.page.dtype
+        self.segment_shape = (self.page.tilelength, self.page.tilewidth) if self.page.is_tiled else (min(self.page.rowsperstrip, h), w)
+        self.grid = tuple(-(-s//c) for s, c in zip((h, w), self.segment_shape))
+
+    @property
+    def ndim(self): return len(self.shape)
+
+    def __getitem__(self, idx):
+        idx = idx if isinstance(idx, tuple) else (idx,)
+        idx += (slice(None),)*(2-len(idx))
+        (r0, r1, rs), (c0, c1, cs) = [sl.indices(s) for sl, s in zip(idx[:2], self.shape)]
+        assert rs==1 and cs==1, 'Regions must be selected with slices'
+        out = np.zeros((max(r1-r0, 0), max(c1-c0, 0), self.shape[2]), dtype=self.dtype)
+        if out.size==0: return out[(slice(None),)*2 + idx[2:]]
+        (th, tw), (gh, gw) = self.segment_shape, self.grid
+        planes = self.page.shaped[0]
+        indices = [p*gh*gw + i*gw + j for p in range(planes) for i in range(r0//th, -(-r1//th)) for j in range(c0//tw, -(-c1//tw))]
+        offsets = [self.page.dataoffsets[i] for i in indices]
+        bytecounts = [self.page.databytecounts[i] for i in indices]
+        for data, i in self.tif.filehandle.read_segments(offsets, bytecounts, indices=indices):
+            if data is None or len(data)==0: continue
+            segment, (p, _, y, x, _), _ = self.page.decode(data, i, jpegtables=self.page.jpegtables)
+            segment = segment[0]
+            ys, xs = slice(max(r0-y, 0), min(r1-y, segment.shape[0])), slice(max(c0-x, 0), min(c1-x, segment.shape[1]))
+            ch = slice(p*segment.shape[-1], (p+1)*segment.shape[-1])
+            out[ys.start+y-r0:ys.stop+y-r0, xs.start+x-c0:xs.stop+x-c0, ch] = segment[ys, xs]
+        return out[(slice(None),)*2 + idx[2:]]
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path.name}, shape={self.shape}, segments={self.segment_shape})'
+
+# Cell
+def _memmap_stack(path):
+    "Memory-map uncompressed TIFF stack (first series) as volume, returns None if not possible"
+    try:
+        return tifffile.memmap(path, series=0, mode='r')
+    except ValueError:
+        return None
+
+# Cell
+def _zarr_array(path):
+    "Zarr array in `path`"
+    z = zarr.open(path.as_posix(), mode='r')
+    return z if isinstance(z, zarr.Array) else None
+
+# Cell
+# Readers that open an image as array-like view with region reads, tried in order for each file extension
+REGION_READERS = {
+    '.npy': [_memmap_img],
+    '.tif': [_memmap_img, TiffRegionReader],
+    '.tiff': [_memmap_img, TiffRegionReader],
+    '.svs': [TiffRegionReader],
+    '.zarr': [_zarr_array],
+}
+
+# Readers for volumes of shape (D,H,W) or (D,H,W,C)
+VOLUME_READERS = {
+    '.npy': [_memmap_img],
+    '.tif': [_memmap_stack],
+    '.tiff': [_memmap_stack],
+    '.zarr': [_zarr_array],
+}
+
+def open_region_reader(path, n_dims=2):
+    "Opens the image (`n_dims=3`: volume) in `path` with the first suitable reader in `REGION_READERS` (`VOLUME_READERS`), returns None if there is none"
+    readers = REGION_READERS if n_dims==2 else VOLUME_READERS
+    for reader in readers.get(Path(path).suffix.lower(), []):
+        try:
+            arr = reader(Path(path))
+        except (ValueError, OSError, tifffile.TiffFileError):
+            continue
+        if arr is not None: return arr
+    return None
+
+# Cell
+def _img_shape(path, n_dims=2):
+    "Spatial shape of the image (`n_dims=3`: volume) in `path`, read from the file header"
+    arr = open_region_reader(path, n_dims)
+    if arr is not None: return tuple(arr.shape[:n_dims])
+    try:
+        if n_dims==2:
+            with Image.open(path) as im: return (im.height, im.width)
+    except OSError:
+        pass
+    return _read_img(path, n_dims=n_dims).shape[:n_dims]
+
+# Cell
+class ImageCache:
+    "Least recently used cache for decoded images, limited to `max_bytes`"
+    def __init__(self, max_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.clear()
+
+    def clear(self):
+        "Empties the cache and resets the hit and miss counters"
+        self.data, self.nbytes, self.hits, self.misses = OrderedDict(), 0, 0, 0
+
+    def __call__(self, key, read_fn):
+        "Returns cached image for `key` or reads it with `read_fn(key)`"
+        if key in self.data:
+            self.hits += 1
+            self.data.move_to_end(key)
+            return self.data[key]
+        self.misses += 1
+        img = read_fn(key)
+        # Lazy (e.g., zarr) arrays are not cached
+        if isinstance(img, np.ndarray) and img.nbytes<=self.max_bytes:
+            self.data[key] = img
+            self.nbytes += img.nbytes
+            self._evict()
+        return img
+
+    def _evict(self):
+        while self.nbytes>self.max_bytes:
+            _, old = self.data.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def resize(self, max_bytes):
+        "Sets `max_bytes`, removing the least recently used images"
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def __getstate__(self):
+        # Cached images are not copied to other processes (e.g., spawned DataLoader workers)
+        return {**self.__dict__, 'data': OrderedDict(), 'nbytes': 0}
+
+    @property
+    def hit_rate(self):
+        return self.hits/max(self.hits+self.misses, 1)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({len(self.data)} images, {self.nbytes/2**20:.1f}/{self.max_bytes/2**20:.1f} MB, hit rate: {self.hit_rate:.2f})'
+
+# Cell
+def _class_histogram(msk, chunk_size=2**24):
+    "Values and pixel counts of `msk`, counted with `np.bincount` in chunks of `chunk_size` for unsigned integer masks"
+    msk = np.asarray(msk)
+    if msk.dtype.kind not in 'bu': return np.unique(msk, return_counts=True)
+    flat, counts = msk.reshape(-1), np.zeros(0, dtype='int64')
+    for i in range(0, flat.size, chunk_size):
+        c = np.bincount(flat[i:i+chunk_size])
+        if len(c)>len(counts): counts = np.pad(counts, (0, len(c)-len(counts)))
+        counts[:len(c)] += c
+    values = np.flatnonzero(counts)
+    return values, counts[values]
+
+def _check_msk(msk, n_classes=2, n_dims=2, hist=None):
+    "Scales 0/255 masks, removes duplicate channels and checks the classes, using the class histogram `hist` if given"
+    values, counts = hist if hist is not None else _class_histogram(msk)
+    if values.max()>n_classes:
+        msk = msk//np.iinfo(msk.dtype).max
+    # Remove channels if no extra information given
+    if len(msk.shape)==n_dims+1:
+        if np.array_equal(msk[...,0], msk[...,1]):
+            msk = msk[...,0]
+    # Mask check (values of equal channels are the same as of the first channel)
+    if values.max()>n_classes: values = np.unique(values//np.iinfo(msk.dtype).max)
+    assert len(values)<=n_classes, 'Check n_classes and provided mask'
+    return msk
+
+# Cell
+# Decoded masks and class histograms of the mask files read with `_read_msk`
+MASK_CACHE = ImageCache(2**28)
+
+def _mask_key(path, **kwargs):
+    "Key of the mask file `path` (modification time, size) read with `kwargs`"
+    st = path.stat()
+    return (path.resolve().as_posix(), st.st_mtime_ns, st.st_size, json.dumps(kwargs, sort_keys=True, default=str))
+
+def _decode_msk(path, key, n_classes=2, instance_labels=False, n_dims=2, **kwargs):
+    "Reads and checks the mask `path`, the class histogram is computed once for each `key` (and kept in `MASK_CACHE`)"
+    msk = _read_volume(path, **kwargs) if n_dims==3 else imageio.imread(path, **kwargs)
+    msk = np.asarray(msk)
+    if not instance_labels:
+        # Values and counts (stacked) are also kept for masks that exceed the cache
+        hist = MASK_CACHE(('hist', *key), lambda k: np.stack(_class_histogram(msk)))
+        msk = _check_msk(msk, n_classes, n_dims, tuple(hist))
+    # Cached masks are shared between the calls
+    msk.setflags(write=False)
+    return msk
+
+def _read_msk(path, n_classes=2, instance_labels=False, n_dims=2, **kwargs):
+    "Read image (`n_dims=3`: volume) and check classes, checked masks are cached (read-only) in `MASK_CACHE`"
+    path = Path(path)
     if path.suffix == '.zarr':
         msk = zarr.convenience.open(path.as_posix())
+        return msk if instance_labels else _check_msk(msk, n_classes, n_dims)
+    key = _mask_key(path, n_classes=n_classes, instance_labels=instance_labels, n_dims=n_dims, **kwargs)
+    return MASK_CACHE(key, lambda k: _decode_msk(path, k, n_classes, instance_labels, n_dims, **kwargs))
+
+# Cell
+def _pdf_shape(shape, reshape=512):
+    "Shape of the resized PDF for a mask of spatial `shape`: `reshape` rows, other axes scaled accordingly"
+    pdf_shape = tuple(reshape if i==len(shape)-2 else max(int((s/shape[-2])*reshape), 1) for i, s in enumerate(shape))
+    # Volumes are only downsampled
+    return pdf_shape if len(shape)==2 else tuple(min(p, s) for p, s in zip(pdf_shape, shape))
+
+# Cell
+def _bin_sum(x, starts):
+    "Sums of `x` over the bins starting at `starts` (one array of start indices per axis)"
+    for ax, st in enumerate(starts): x = np.add.reduceat(x, st, axis=ax, dtype='int64')
+    return x
+
+def _create_cdf(mask, ignore=None, pdf_reshape=512, fbr=None, block_size=2**24):
+    'Creates a cumulated probability density function (CDF) for weighted sampling '
+    # The pdf (1 for foreground, `fbr` for background, 0 for ignored pixels) is area-averaged to the target shape,
+    # reading `mask` (e.g., chunked zarr labels) in blocks of about `block_size` pixels
+    shape = _pdf_shape(mask.shape, pdf_reshape)
+    # Upsampled axes are averaged at full resolution (bins of one pixel) and interpolated below
+    grid = tuple(min(n, s) for n, s in zip(shape, mask.shape))
+    bins = [np.arange(s)*g//s for s, g in zip(mask.shape, grid)]
+    starts = [np.flatnonzero(np.diff(b, prepend=-1)) for b in bins]
+    n_fg, n_bg = np.zeros(grid), np.zeros(grid)
+    n_fg_all, n_bg_all = 0, 0
+
+    rows = max(block_size//int(np.prod(mask.shape[1:])), 1)
+    if isinstance(mask, zarr.Array): rows = max(rows//mask.chunks[0], 1)*mask.chunks[0]
+    for r in range(0, mask.shape[0], rows):
+        fg = np.asarray(mask[r:r+rows])>0
+        n_fg_all += np.count_nonzero(fg)
+        n_bg_all += fg.size-np.count_nonzero(fg)
+        valid = np.ones_like(fg) if ignore is None else ~np.asarray(ignore[r:r+rows], dtype=bool)
+        # Bins of the rows in this block (bins may continue in the next block)
+        row_bins = bins[0][r:r+rows]
+        row_starts = np.flatnonzero(np.diff(row_bins, prepend=-1))
+        block_starts = [row_starts, *starts[1:]]
+        fg_sum = _bin_sum(fg&valid, block_starts)
+        n_fg[row_bins[row_starts]] += fg_sum
+        n_bg[row_bins[row_starts]] += _bin_sum(valid, block_starts)-fg_sum
+
+    fbr = fbr or n_fg_all/max(n_bg_all, 1)
+    n_pix = functools.reduce(np.multiply.outer, [np.diff(np.append(st, s)) for st, s in zip(starts, mask.shape)])
+    pdf = (n_fg + n_bg*fbr)/n_pix
+
+    #if igonore_edges:
+    #    w = int(self.tile_shape[0]*0.25)
+    #    pdf[:, :w] = pdf[:, -w:] = 0
+    #    pdf[:w, :] = pdf[-w:, :] = 0
+
+    if pdf.shape!=shape: pdf = cv2.resize(pdf, dsize=shape[::-1])
+
+    return np.cumsum(pdf/np.sum(pdf))
+
+# Cell
+def _cache_key(label_path, ignore=None, chunk_size=2**24, **kwargs):
+    "Key for preprocessing cache entries from mask content, ignore mask, and preprocessing parameters `kwargs`"
+    h = hashlib.md5(json.dumps(kwargs, sort_keys=True).encode())
+    if label_path.is_dir():
+        # Chunked masks (e.g., .zarr): use file names, sizes, and modification times
+        for f in sorted(label_path.rglob('*')):
+            st = f.stat()
+            h.update(f'{f.relative_to(label_path)}{st.st_size}{st.st_mtime_ns}'.encode())
     else:
-        msk = imageio.imread(path, **kwargs)
-    if not instance_labels:
-        if np.max(msk)>n_classes:
-            msk = msk//np.iinfo(msk.dtype).max
-        # Remove channels if no extra information given
-        if len(msk.shape)==3:
-            if np.array_equal(msk[...,0], msk[...,1]):
-                msk = msk[...,0]
-        # Mask check
-        assert len(np.unique(msk))<=n_classes, 'Check n_classes and provided mask'
-    return msk
+        # Mask files are hashed in chunks of `chunk_size` bytes
+        with open(label_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''): h.update(chunk)
+    if ignore is not None:
+        ignore = np.ascontiguousarray(ignore[:])
+        h.update(str(ignore.shape).encode())
+        h.update(ignore.tobytes())
+    return h.hexdigest()
+
+# Cell
+def _stats_key(files, **kwargs):
+    "Key for cached dataset statistics from file names, sizes, modification times and parameters `kwargs`"
+    h = hashlib.md5(json.dumps(kwargs, sort_keys=True).encode())
+    for f in files:
+        st = f.stat()
+        h.update(f'{f.name}{st.st_size}{st.st_mtime_ns}'.encode())
+    return h.hexdigest()
+
+# Cell
+def _combine_stats(a, b):
+    "Combines pixel count, mean and sum of squared deviations of `a` and `b` (Chan et al.)"
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    return n, mean_a + delta*n_b/n, m2_a + m2_b + delta**2*n_a*n_b/n
+
+# Cell
+class LazyImage:
+    "Read-only, array-like view of the image (`n_dims=3`: volume) in `path` that reads regions on access, normalized like `_read_img`"
+    def __init__(self, path, read_fn=None, cache=None, n_dims=2):
+        self.path, self.n_dims = Path(path), n_dims
+        self.read_fn = read_fn or functools.partial(_read_img, n_dims=n_dims)
+        self.cache = cache or ImageCache(0)
+        self._array, self._norm = None, None
+
+    @property
+    def ndim(self): return self.n_dims+1
+
+    @property
+    def array(self):
+        "View with region reads from `open_region_reader` or False if the file format does not allow region reads"
+        if self._array is None:
+            arr = open_region_reader(self.path, self.n_dims)
+            self._array = False if arr is None else arr
+        return self._array
+
+    def _region(self, idx):
+        "Region of `array` as (H,W,C) or (D,H,W,C) array, selected with slices"
+        idx = idx if isinstance(idx, tuple) else (idx,)
+        data = np.asarray(self.array[idx[:self.n_dims]])
+        if data.ndim==self.n_dims: data = data[..., None]
+        return data[(slice(None),)*self.n_dims + idx[self.n_dims:]]
+
+    @property
+    def norm(self):
+        "Divisor for the intensity normalization of `_read_img`"
+        if self._norm is None:
+            # Scan chunks of rows (slices) until the first intensity above 1
+            self._norm, rows = 1, max(2**22//int(np.prod(self.shape[1:])), 1)
+            for r in range(0, self.shape[0], rows):
+                if self._region(slice(r, r+rows)).max()>1.:
+                    self._norm = np.iinfo(self.array.dtype).max
+                    break
+        return self._norm
+
+    @property
+    def shape(self):
+        if self.array is False: return self.read().shape
+        shape = tuple(self.array.shape)
+        return shape if len(shape)==self.ndim else (*shape, 1)
+
+    def read(self):
+        "Decoded image, kept in `cache`"
+        return self.cache(self.path, self.read_fn)
+
+    def __getitem__(self, idx):
+        if self.array is False: return self.read()[idx]
+        data = self._region(idx)
+        return data/self.norm if self.norm!=1 else data
+
+    def close(self):
+        "Releases the region reader, which is reopened on the next access"
+        self._array = None
+
+    def __getstate__(self):
+        # Memory maps and file handles are reopened in each process instead of being pickled
+        return {**self.__dict__, '_array': None}
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path.name}, region reads: {self.array is not False})'
+
+# Cell
+def _image_stats(path, subsample=1, chunk_rows=256, n_dims=2, read_fn=None):
+    "Streams over rows (`n_dims=3`: slices) of image at `path` and returns pixel count, mean and sum of squared deviations per channel"
+    # Region reads if the format allows (see `LazyImage`), otherwise the image is decoded with `read_fn` (default: `_read_img`)
+    img = LazyImage(path, read_fn=read_fn, n_dims=n_dims)
+    data = img.read() if img.array is False else None
+    region, shape = (img._region, img.shape) if data is None else (data.__getitem__, data.shape)
+    # Read along zarr chunks to avoid loading the whole image
+    if isinstance(img.array, zarr.Array): chunk_rows = img.array.chunks[0]
+    chunk_rows = max(chunk_rows//subsample, 1)*subsample
+    n_ch = shape[-1]
+    stats, img_max = (0, np.zeros(n_ch), np.zeros(n_ch)), 0
+    for start in range(0, shape[0], chunk_rows):
+        x = region((slice(start, start+chunk_rows, subsample),) + (slice(None, None, subsample),)*(n_dims-1))
+        img_max = max(img_max, x.max())
+        x = x.reshape(-1, n_ch).astype(np.float64)
+        mean = x.mean(0)
+        stats = _combine_stats(stats, (x.shape[0], mean, ((x-mean)**2).sum(0)))
+    # Normalize region reads to 0-1 range (decoded images are normalized by `read_fn`, see `_read_img`)
+    if img.array is not False and img_max>1. and np.issubdtype(img.array.dtype, np.integer):
+        scale = np.iinfo(img.array.dtype).max
+        stats = (stats[0], stats[1]/scale, stats[2]/scale**2)
+    return stats
+
+# Cell
+def _preproc_item(item, preproc_dir, read_mask=None, n_classes=2, instance_labels=False, remove_overlap=True, pdf_reshape=512, n_dims=2):
+    "Preprocesses `item` (name, label path, ignore, cache key) and saves labels and pdf to the zarr groups in `preproc_dir`."
+    name, label_path, ign, key = item
+    # Masks are read with the (picklable) reader of the dataset, e.g. `BaseDataset.read_mask`
+    read_mask = read_mask or functools.partial(_read_msk, n_dims=n_dims)
+    if instance_labels:
+        clabels = None
+        instlabels = read_mask(label_path, n_classes, instance_labels=True)
+    else:
+        clabels = read_mask(label_path, n_classes)
+        instlabels = None
+    lbl = preprocess_mask(clabels, instlabels, n_dims=n_dims, remove_overlap=remove_overlap)
+    # Each process only writes its own arrays, group metadata already exists
+    labels = zarr.open_group((preproc_dir/'labels').as_posix())
+    pdfs = zarr.open_group((preproc_dir/'pdfs').as_posix())
+    labels[name] = lbl
+    del lbl
+    # The pdf is computed blockwise from the chunked labels
+    pdfs[name] = _create_cdf(labels[name], ign, pdf_reshape)
+    # Mask file of the entry (see `BaseDataset.prune_cache`)
+    labels[name].attrs['source'] = pdfs[name].attrs['source'] = Path(label_path).resolve().as_posix()
+    # Cache keys are written last, incomplete entries are recomputed
+    labels[name].attrs['cache_key'] = pdfs[name].attrs['cache_key'] = key
+
+# Cell
+def _downsample(arr, f, nearest=False, argmax=False, block_rows=1024):
+    "Downsamples the first two axes of `arr` (numpy or zarr array) by `f` in row blocks (area mean, `nearest` for labels)"
+    h, w = arr.shape[0]//f, arr.shape[1]//f
+    rows, out = max(block_rows//f, 1)*f, []
+    for start in range(0, h*f, rows):
+        stop = min(start+rows, h*f)
+        if nearest: x = np.asarray(arr[start+f//2:stop:f, f//2:w*f:f])
+        else:
+            x = np.asarray(arr[start:stop, :w*f])
+            x = x.reshape(len(x)//f, f, w, f, *x.shape[2:]).mean(axis=(1,3)).astype(x.dtype)
+        # Predictions from softmax
+        if argmax: x = x.argmax(-1).astype('uint8')
+        out.append(x)
+    return np.concatenate(out)
+
+# Cell
+class ThumbnailCache:
+    "Thumbnail pyramids of images, labels, predictions (argmax of softmax) and uncertainty maps, stored in a zarr group at `path`"
+    kinds = ('image', 'label', 'pred', 'unc')
+    def __init__(self, path=None, max_size=1024, min_size=128, block_rows=1024):
+        self.path = Path(path) if path else None
+        store_attr('max_size, min_size, block_rows')
+        self._root = None
+
+    @property
+    def root(self):
+        # In-memory group if no `path` is given
+        if self._root is None: self._root = zarr.open_group(self.path.as_posix()) if self.path else zarr.group()
+        return self._root
+
+    def _source_key(self, source, kind):
+        "Entry name and key (modification time, size, pyramid parameters) of `source`"
+        path = Path(source).resolve()
+        st = path.stat()
+        name = hashlib.md5(f'{path.as_posix()}{kind}'.encode()).hexdigest()
+        return name, f'{path.as_posix()}:{st.st_mtime_ns}:{st.st_size}:{kind}:{self.max_size}:{self.min_size}'
+
+    def _read(self, source, kind, read_fn=None):
+        "Full resolution data of `source`, chunked data (e.g. softmax zarr arrays) is opened lazily"
+        if read_fn is not None: return read_fn(source)
+        if Path(source).is_dir(): return zarr.open_array(Path(source).as_posix(), mode='r')
+        if kind=='image': return _read_img(source)
+        if kind=='label': return _read_msk(source)
+        return imageio.imread(source)
+
+    def _pyramid(self, arr, kind):
+        "Levels halving the size from at most `max_size` to `min_size` pixels on the longer side"
+        nearest, argmax = kind in ('label', 'pred'), kind=='pred'
+        f = 2**max(0, math.ceil(math.log2(max(arr.shape[:2])/self.max_size)))
+        levels = [_downsample(arr, f, nearest, argmax, self.block_rows)]
+        # Normalized images (see `_read_img`) in single precision
+        if levels[0].dtype==np.float64: levels[0] = levels[0].astype('float32')
+        while max(levels[-1].shape[:2])>self.min_size: levels.append(_downsample(levels[-1], 2, nearest))
+        return levels
+
+    def levels(self, source, kind='image', read_fn=None):
+        "Pyramid levels (zarr arrays) of `source`, created on first access and when the source changes"
+        assert kind in self.kinds, f'kind must be one of {self.kinds}'
+        name, key = self._source_key(source, kind)
+        g = self.root[name] if name in self.root else None
+        if g is None or g.attrs.get('key')!=key:
+            g = self.root.create_group(name, overwrite=True)
+            levels = self._pyramid(self._read(source, kind, read_fn), kind)
+            for i, lvl in enumerate(levels): g.array(str(i), lvl, chunks=False)
+            # Keys are written last, incomplete entries are recreated
+            g.attrs.update(key=key, source=str(source), n_levels=len(levels))
+        return [g[str(i)] for i in range(g.attrs['n_levels'])]
+
+    def get(self, source, kind='image', size=1024, read_fn=None):
+        "Smallest thumbnail of `source` with at least `size` pixels on the longer side (or the largest level)"
+        levels = self.levels(source, kind, read_fn)
+        lvl = next((l for l in levels[::-1] if max(l.shape[:2])>=size), levels[0])
+        return lvl[:]
+
+    def read(self, source, kind='image', size=None, read_fn=None):
+        "Thumbnail of `source` for `size`, full resolution data if `size` is None"
+        if size: return self.get(source, kind, size, read_fn)
+        data = self._read(source, kind, read_fn)
+        return np.argmax(data[:], axis=-1).astype('uint8') if kind=='pred' else np.asarray(data[:])
+
+    def prune(self):
+        "Removes the pyramids of sources that do not exist anymore"
+        pruned = [name for name, g in self.root.groups() if 'source' not in g.attrs or not Path(g.attrs['source']).exists()]
+        for name in pruned: del self.root[name]
+        return pruned
 
 # Cell
 class BaseDataset(Dataset):
     def __init__(self, files, label_fn=None, instance_labels = False, n_classes=2, ignore={},remove_overlap=True,stats=None,normalize=True,
-                 tile_shape=(512,512), padding=(0,0),preproc_dir=None, verbose=1, scale=1, pdf_reshape=512, **kwargs):
-        store_attr('files, label_fn, instance_labels, n_classes, ignore, tile_shape, remove_overlap, padding, normalize, scale, pdf_reshape')
+                 tile_shape=(512,512), padding=(0,0),preproc_dir=None, verbose=1, scale=1, pdf_reshape=512, preproc_workers=0, thumbnail_dir=None, **kwargs):
+        store_attr('files, label_fn, instance_labels, n_classes, ignore, tile_shape, remove_overlap, padding, normalize, scale, pdf_reshape, preproc_workers')
         self.c = n_classes
+        # zarr handles of the process (see `init_worker`)
+        self._handles = {}
+        # Images (2) or volumes (3), following the tile shape
+        self.n_dims = len(tile_shape)
+        # Padding in the image plane only (e.g., padding=(184,184) for tile_shape=(16,540,540))
+        self.padding = (0,)*(self.n_dims-len(padding)) + tuple(padding)
+
+        if preproc_dir: self.preproc_dir = Path(preproc_dir)
+        elif label_fn is not None: self.preproc_dir = Path(label_fn(files[0])).parent/'.cache'
+        else: self.preproc_dir = None
+        # Thumbnails are cached next to the preprocessed masks (in memory if no directory is given)
+        self.thumbnail_dir = thumbnail_dir or (self.preproc_dir/'thumbnails' if self.preproc_dir else None)
 
         if self.normalize:
             self.stats = stats or self.compute_stats()
 
         if label_fn is not None:
-            if not preproc_dir: self.preproc_dir = Path(label_fn(files[0])).parent/'.cache'
-            else: self.preproc_dir = Path(preproc_dir)
-            self.labels = zarr.group((self.preproc_dir/'labels').as_posix())
-            self.pdfs = zarr.group((self.preproc_dir/'pdfs').as_posix())
             self._preproc(verbose)
 
+    def _zarr(self, name):
+        "zarr group (`name`) or array (`(group, name)`) of the preprocessing cache, opened once per process"
+        if name not in self._handles:
+            if isinstance(name, tuple): self._handles[name] = self._zarr(name[0])[name[1]]
+            else: self._handles[name] = zarr.group((self.preproc_dir/name).as_posix())
+        return self._handles[name]
+
+    @property
+    def labels(self): return self._zarr('labels')
+
+    @property
+    def pdfs(self): return self._zarr('pdfs')
+
+    @property
+    def thumbnails(self):
+        "`ThumbnailCache` of the images, labels and results in `thumbnail_dir`"
+        if 'thumbnails' not in self._handles: self._handles['thumbnails'] = ThumbnailCache(self.thumbnail_dir)
+        return self._handles['thumbnails']
+
+    def init_worker(self, worker_id=0, num_workers=1):
+        "Prepares the dataset copy of a DataLoader worker: reopens the zarr handles and splits the image cache"
+        self._handles = {}
+        if getattr(self, 'img_cache', None) is not None: self.img_cache.resize(self.img_cache.max_bytes//num_workers)
+
+    def __getstate__(self):
+        # zarr handles are reopened in each process instead of being pickled
+        return {**self.__dict__, '_handles': {}}
+
     def read_img(self, *args, **kwargs):
-        return _read_img(*args, **kwargs)
+        return _read_img(*args, n_dims=self.n_dims, **kwargs)
 
     def read_mask(self, *args, **kwargs):
-        return _read_msk(*args, **kwargs)
+        return _read_msk(*args, n_dims=self.n_dims, **kwargs)
 
     def _create_cdf(self, mask, ignore, fbr=None):
         'Creates a cumulated probability density function (CDF) for weighted sampling '
+        return _create_cdf(mask, ignore, self.pdf_reshape, fbr)
 
-        # Create probability density function
-        mask = mask[:]
-        fbr = fbr or np.sum(mask>0)/np.sum(mask==0)
-        pdf = (mask>0) + (mask==0) * fbr
-
-        # Set weight and sampling probability for ignored regions to 0
-        if ignore is not None:
-            pdf[ignore[:]] = 0
+    @property
+    def _preproc_params(self):
+        params = {'n_classes': self.c, 'instance_labels': self.instance_labels,
+                  'remove_overlap': self.remove_overlap, 'pdf_reshape': self.pdf_reshape}
+        # Only set for volumes to keep the cache keys of images
+        if self.n_dims!=2: params['n_dims'] = self.n_dims
+        return params
 
-        #if igonore_edges:
-        #    w = int(self.tile_shape[0]*0.25)
-        #    pdf[:, :w] = pdf[:, -w:] = 0
-        #    pdf[:w, :] = pdf[-w:, :] = 0
+    def _get_preproc_item(self, file):
+        "Returns name, label path, ignore mask, and cache key of `file`"
+        label_path, ign = Path(self.label_fn(file)), self.ignore.get(file.name)
+        return file.name, label_path, ign, _cache_key(label_path, ign, **self._preproc_params)
 
-        reshape_w = int((pdf.shape[1]/pdf.shape[0])*self.pdf_reshape)
-        pdf = cv2.resize(pdf, dsize=(reshape_w, self.pdf_reshape))
-
-        return np.cumsum(pdf/np.sum(pdf))
+    def _is_cached(self, name, key):
+        return all(name in g and g[name].attrs.get('cache_key')==key for g in (self.labels, self.pdfs))
 
     def _preproc_file(self, file):
         "Preprocesses and saves labels (msk), weights, and pdf."
-        label_path = self.label_fn(file)
-        if self.instance_labels:
-            clabels = None
-            instlabels = self.read_mask(label_path,  self.c, instance_labels=True)
-        else:
-            clabels = self.read_mask(label_path, self.c)
-            instlabels = None
-        ign = self.ignore[file.name] if file.name in self.ignore else None
-        lbl = preprocess_mask(clabels, instlabels, n_dims=self.c, remove_overlap=self.remove_overlap)
-        self.labels[file.name] = lbl
-        self.pdfs[file.name] = self._create_cdf(lbl, ignore=ign)
+        _preproc_item(self._get_preproc_item(file), self.preproc_dir, self.read_mask, **self._preproc_params)
 
     def _preproc(self, verbose=0):
-        using_cache = False
-        for f in self.files:
-            try:
-                #lbl, wgt, pdf = _get_cached_data(self._cache_fn(f.name))
-                self.labels[f.name]
-                self.pdfs[f.name]
-                if not using_cache:
-                    if verbose>0: print(f'Using preprocessed masks from {self.preproc_dir}')
-                    using_cache = True
-            except:
-                    if verbose>0: print('Preprocessing', f.name)
-                    self._preproc_file(f)
+        items = [self._get_preproc_item(f) for f in self.files]
+        preproc_items = [item for item in items if not self._is_cached(item[0], item[3])]
+        self.cache_stats = {'hits': len(items)-len(preproc_items), 'misses': len(preproc_items)}
+        if verbose>0 and self.cache_stats['hits']>0:
+            print(f"Using {self.cache_stats['hits']} preprocessed masks from {self.preproc_dir}")
+
+        if self.preproc_workers>0 and len(preproc_items)>1:
+            if verbose>0: print(f'Preprocessing {len(preproc_items)} files with {self.preproc_workers} workers')
+            parallel(_preproc_item, preproc_items, n_workers=self.preproc_workers, progress=verbose>0,
+                     preproc_dir=self.preproc_dir, read_mask=self._worker_read_mask(), **self._preproc_params)
+        else:
+            for item in preproc_items:
+                if verbose>0: print('Preprocessing', item[0])
+                _preproc_item(item, self.preproc_dir, self.read_mask, **self._preproc_params)
+
+    def _worker_read_mask(self):
+        "`read_mask` of a dataset copy without label function (e.g., a lambda) and ignore masks that is picklable for the preprocessing workers"
+        ds = copy(self)
+        ds.label_fn, ds.ignore = None, {}
+        return ds.read_mask
+
+    def prune_cache(self, verbose=1):
+        "Removes cache entries that are incomplete or whose mask file does not exist anymore"
+        pruned = []
+        # Entries of other datasets (e.g., folds) sharing `preproc_dir` are kept
+        for name in set(self.labels.array_keys()) | set(self.pdfs.array_keys()):
+            attrs = [g[name].attrs if name in g else {} for g in (self.labels, self.pdfs)]
+            if all('cache_key' in a and Path(a.get('source', '.')).exists() for a in attrs): continue
+            for g in (self.labels, self.pdfs):
+                if name in g: del g[name]
+            pruned.append(name)
+        if verbose>0: print(f'Pruned {len(pruned)} entries from {self.preproc_dir}')
+        return pruned
 
     def get_data(self, files=None, max_n=None, mask=False):
         if files is not None:
@@ -370,7 +954,7 @@ class BaseDataset(Dataset):
             data_list.append(d)
         return data_list
 
-    def show_data(self, files=None, max_n=6, ncols=1, figsize=None, **kwargs):
+    def show_data(self, files=None, max_n=6, ncols=1, figsize=None, thumbnail_size=1024, **kwargs):
         if files is not None:
             files = L(files)
             max_n = len(files)
@@ -379,9 +963,17 @@ class BaseDataset(Dataset):
             files = self.files[:max_n]
         if figsize is None: figsize = (ncols*12, max_n//ncols * 5)
         for f in files:
-            img = self.read_img(f)
+            # Images: thumbnails (full resolution if `thumbnail_size` is None)
+            if self.n_dims==2 and thumbnail_size:
+                img = self.thumbnails.get(f, 'image', thumbnail_size, read_fn=self.read_img)
+            else: img = self.read_img(f)
+            # Volumes: center slice
+            if self.n_dims==3: img = img[len(img)//2]
             if self.label_fn is not None:
-                lbl = self.labels[f.name]
+                if self.n_dims==2 and thumbnail_size:
+                    lbl = self.thumbnails.get(self.preproc_dir/'labels'/f.name, 'label', thumbnail_size)
+                else: lbl = self.labels[f.name]
+                if self.n_dims==3: lbl = lbl[len(lbl)//2]
                 show(img, lbl, file_name=f.name, figsize=figsize, show_bbox=False, **kwargs)
             else:
                 show(img, file_name=f.name, figsize=figsize, show_bbox=False, **kwargs)
@@ -393,36 +985,109 @@ class BaseDataset(Dataset):
             print(f"Deleting all cache at {self.preproc_dir}")
         except: print(f"No temporary files to delete at {self.preproc_dir}")
 
-    #https://stackoverflow.com/questions/60101240/finding-mean-and-standard-deviation-across-image-channels-pytorch/60803379#60803379
-    def compute_stats(self, max_samples=50):
-        "Computes mean and std from files"
+    def compute_stats(self, max_samples=50, subsample=1):
+        "Computes mean and std from files in a single streaming pass, results are cached in `preproc_dir`"
+        files = self.files[:max_samples]
+        key = _stats_key(files, subsample=subsample, **({'n_dims': self.n_dims} if self.n_dims!=2 else {}))
+        cache_file = self.preproc_dir/'stats.json' if self.preproc_dir else None
+        cache = json.loads(cache_file.read_text()) if cache_file and cache_file.exists() else {}
+        if key in cache:
+            self.mean, self.std = np.array(cache[key]['mean']), np.array(cache[key]['std'])
+            return self.mean, self.std
+
         print('Computing Stats...')
-        mean_sum, var_sum = 0., 0.
-        for i, f in enumerate(self.files, 1):
-            img = self.read_img(f)[:]
-            mean_sum += img.mean((0,1))
-            var_sum += img.var((0,1))
-            if i==max_samples:
-                print(f'Calculated stats from {i} files')
-                continue
-        self.mean = mean_sum/i
-        self.std = np.sqrt(var_sum/i)
+        n, mean, m2 = 0, 0., 0.
+        for f in files:
+            n, mean, m2 = _combine_stats((n, mean, m2), _image_stats(f, subsample, n_dims=self.n_dims, read_fn=self.read_img))
+        if len(self.files)>max_samples: print(f'Calculated stats from {len(files)} files')
+        self.mean = mean
+        self.std = np.sqrt(m2/n)
+
+        if cache_file:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            cache[key] = {'mean': self.mean.tolist(), 'std': self.std.tolist()}
+            cache_file.write_text(json.dumps(cache))
         return self.mean, self.std
 
+# Cell
+class CenterSampler:
+    "Samples tile centers from the CDFs in `pdfs` with binary search, drawing `n_draws` centers per image at once"
+    def __init__(self, pdfs, labels, reshape=512, n_draws=1, n_dims=2):
+        store_attr('pdfs, labels, reshape, n_draws, n_dims')
+        self.cdfs, self.shapes, self.queues = {}, {}, {}
+        # CDFs in shared memory and their version (see `share`)
+        self.shared, self.version, self._version = {}, None, 0
+
+    def _load(self, name):
+        "Keeps CDF and mask shape of `name` in memory"
+        if name in self.shared: return self.shared[name].numpy(), self.shapes[name]
+        if name not in self.cdfs:
+            self.cdfs[name] = self.pdfs[name][:]
+            self.shapes[name] = self.labels[name].shape[:self.n_dims]
+        return self.cdfs[name], self.shapes[name]
+
+    def share(self, names):
+        "Moves the CDFs of `names` to shared memory, so that updates (`update_cdf`) reach the DataLoader workers"
+        if self.version is None: self.version = torch.zeros(1, dtype=torch.int64).share_memory_()
+        for name in names:
+            if name in self.shared: continue
+            cdf, _ = self._load(name)
+            self.shared[name] = torch.from_numpy(np.array(cdf, dtype='float64')).share_memory_()
+            self.cdfs.pop(name)
+
+    def update_cdf(self, name, cdf):
+        "Replaces the (shared) CDF of `name`, queued centers of all images are discarded"
+        self.shared[name].numpy()[:] = cdf
+        self.version += 1
+
+    def sample(self, name, n=1):
+        "Draws `n` random centers (array of shape (n, n_dims)) for image `name`"
+        cdf, shape = self._load(name)
+        grid = _pdf_shape(shape, self.reshape)
+        idx = np.searchsorted(cdf, np.random.random(n), side='right').clip(max=len(cdf)-1)
+        return np.stack([(c*s/g).astype(int) for c, s, g in zip(np.unravel_index(idx, grid), shape, grid)], axis=1)
+
+    def __call__(self, name):
+        "Returns the next pre-drawn center for image `name`"
+        if self.version is not None and self.version.item()!=self._version:
+            self._version = self.version.item()
+            self.queues.clear()
+        if not self.queues.get(name): self.queues[name] = self.sample(name, self.n_draws).tolist()
+        return tuple(self.queues[name].pop())
+
+# Cell
+def _apply_tfms(tfms, img, msk=None):
+    "Applies albumentations `tfms` to `img` and `msk`, volumes (D,H,W,C) are transformed as stacked slices (D*H,W,C)"
+    shape = img.shape
+    if len(shape)==4:
+        # Only pixel-wise (e.g., intensity) transforms are meaningful for volumes
+        img = img.reshape(-1, *shape[2:])
+        if msk is not None: msk = msk.reshape(-1, shape[2])
+    aug = tfms(image=img) if msk is None else tfms(image=img, mask=msk)
+    if len(shape)==4:
+        aug['image'] = aug['image'].reshape(-1, *shape[:3])
+        if msk is not None: aug['mask'] = aug['mask'].reshape(shape[:3])
+    return aug
+
 # Cell
 class RandomTileDataset(BaseDataset):
     """
     Pytorch Dataset that creates random tiles with augmentations from the input images.
     """
     n_inp = 1
-    def __init__(self, *args, sample_mult=None, flip=True, rotation_range_deg=(0, 360), scale_range=(0, 0), albumentations_tfms=[A.RandomGamma()], **kwargs):
+    def __init__(self, *args, sample_mult=None, flip=True, rotation_range_deg=(0, 360), scale_range=(0, 0), albumentations_tfms=[A.RandomGamma()],
+                 img_cache_bytes=0, batch_aug=False, lazy=True, **kwargs):
         super().__init__(*args, **kwargs)
-        store_attr('sample_mult, flip, rotation_range_deg, scale_range, albumentations_tfms')
+        store_attr('sample_mult, flip, rotation_range_deg, scale_range, albumentations_tfms, batch_aug, lazy')
+        # Items include image index and center of the tiles (see `HardExampleSampler`)
+        self.return_center = False
+        # Decoded images, each DataLoader worker holds its own cache
+        self.img_cache = ImageCache(img_cache_bytes)
 
         # Sample mulutiplier: Number of random samplings from augmented image
         if self.sample_mult is None:
             tile_shape = np.array(self.tile_shape)-np.array(self.padding)
-            msk_shape = np.array(self.get_data(max_n=1)[0].shape[:-1])
+            msk_shape = np.array(_img_shape(self.files[0], self.n_dims))
             #msk_shape = np.array(lbl.shape[-2:])
             self.sample_mult = int(np.product(np.floor(msk_shape/tile_shape)))
 
@@ -433,14 +1098,38 @@ class RandomTileDataset(BaseDataset):
                 A.Normalize(mean=self.stats[0], std=self.stats[1], max_pixel_value=1.)
             ]
         self.tfms =  A.Compose(tfms+[ToTensorV2()])
-
-    def _random_center(self, pdf, orig_shape, reshape=512):
-        'Sample random center using PDF'
-        reshape_y = int((orig_shape[1]/orig_shape[0])*reshape)
-        cx, cy = np.unravel_index(np.argmax(pdf > random.random()), (reshape,reshape_y))
-        cx = int(cx*orig_shape[0]/reshape)
-        cy = int(cy*orig_shape[1]/reshape_y)
-        return cx, cy
+        # Draw one epoch of centers per image at once (datasets without labels are not sampled)
+        self.sampler = CenterSampler(self.pdfs, self.labels, self.pdf_reshape, n_draws=self.sample_mult, n_dims=self.n_dims) if self.label_fn else None
+
+        if self.batch_aug:
+            # Axis-aligned crops that contain every flipped, rotated (in plane) and scaled tile, warped by `BatchAugmentation`
+            max_scale = max(self.scale_range) if sum(self.scale_range)!=0 else 1
+            rot = math.sqrt(2) if self.rotation_range_deg[1] > self.rotation_range_deg[0] else 1
+            self.crop_shape = tuple(2*math.ceil(t*max_scale*(rot if i>=self.n_dims-2 else 1)/2) for i, t in enumerate(self.tile_shape))
+            self.crop_field = DeformationField(self.crop_shape, self.scale)
+
+    def init_worker(self, *args, **kwargs):
+        super().init_worker(*args, **kwargs)
+        if self.sampler is None: return
+        # Centers drawn in the main process would be repeated in each worker
+        self.sampler.pdfs, self.sampler.labels = self.pdfs, self.labels
+        self.sampler.queues.clear()
+
+    def _image(self, path):
+        "Image in `path` as `LazyImage` (opened once per process) if `lazy` and the format allows region reads, otherwise decoded and kept in `img_cache`"
+        key = ('image', path.name)
+        if self.lazy and key not in self._handles: self._handles[key] = LazyImage(path, self.read_img, self.img_cache, n_dims=self.n_dims)
+        if self.lazy and self._handles[key].array is not False: return self._handles[key]
+        return self.img_cache(path, self.read_img)
+
+    def _crop(self, data, center):
+        "Axis-aligned crop of `crop_shape` around `center` with reflected borders (see `DeformationField.apply`)"
+        if self.scale!=1: return self.crop_field.apply(data, center)
+        lo = [int(c)-s//2 for c, s in zip(center, self.crop_shape)]
+        sl = tuple(slice(max(l, 0), min(l+s, d)) for l, s, d in zip(lo, self.crop_shape, data.shape))
+        pad = [(s.start-l, l+c-s.stop) for s, l, c in zip(sl, lo, self.crop_shape)]
+        pad += [(0, 0)]*(data.ndim-len(self.crop_shape))
+        return np.pad(data[sl], pad, mode='symmetric')
 
     def __len__(self):
         return len(self.files)*self.sample_mult
@@ -451,11 +1140,16 @@ class RandomTileDataset(BaseDataset):
             idx = idx.tolist()
 
         img_path = self.files[idx]
-        img = self.read_img(img_path)
+        img = self._image(img_path)
 
-        msk = self.labels[img_path.name]
-        pdf = self.pdfs[img_path.name]
-        center = self._random_center(pdf[:], msk.shape)
+        msk = self._zarr(('labels', img_path.name))
+        center = self.sampler(img_path.name)
+
+        if self.batch_aug:
+            img, msk = self._crop(img, center), self._crop(msk, center)
+            if img.ndim==self.n_dims: img = img[...,None]
+            item = torch.from_numpy(np.moveaxis(img, -1, 0).astype('float32')), torch.from_numpy(msk.astype('int64'))
+            return (*item, torch.tensor([idx, *center])) if self.return_center else item
 
         deformationField = DeformationField(self.tile_shape, self.scale, self.scale_range)
         if self.flip:
@@ -467,26 +1161,298 @@ class RandomTileDataset(BaseDataset):
         img = deformationField.apply(img, center)
         msk = deformationField.apply(msk, center)
 
-        aug = self.tfms(image=img, mask=msk)
+        aug = _apply_tfms(self.tfms, img, msk)
 
+        if self.return_center: return aug['image'], aug['mask'].type(torch.int64), torch.tensor([idx, *center])
         return  aug['image'], aug['mask'].type(torch.int64)
 
+    def batch_augmentation(self):
+        "`BatchAugmentation` callback with the augmentation settings of the dataset"
+        kwargs = {'p_gamma':0.}
+        for tfm in self.albumentations_tfms:
+            if isinstance(tfm, A.RandomGamma):
+                kwargs.update(gamma_limit=tfm.gamma_limit, p_gamma=tfm.p)
+            elif isinstance(tfm, A.RandomBrightnessContrast):
+                kwargs.update(brightness_limit=tfm.brightness_limit, contrast_limit=tfm.contrast_limit, p_brightness_contrast=tfm.p)
+            elif not isinstance(tfm, A.Normalize):
+                print(f'{tfm.__class__.__name__} is not supported for batch augmentation and will be skipped.')
+        stats = self.stats if self.normalize else None
+        return BatchAugmentation(self.tile_shape, self.flip, self.rotation_range_deg, self.scale_range, stats=stats, **kwargs)
+
+    def hard_example_sampler(self, **kwargs):
+        "`HardExampleSampler` callback that draws more tiles from high-loss regions of the images"
+        return HardExampleSampler(self, **kwargs)
+
+    def _shard_key(self, file, **kwargs):
+        "Key for the shards of `file` from image, preprocessed mask, augmentation settings and `kwargs`"
+        params = {'tile_shape': list(self.tile_shape), 'padding': list(self.padding), 'scale': self.scale, 'scale_range': list(self.scale_range),
+                  'flip': self.flip, 'rotation_range_deg': list(self.rotation_range_deg), 'batch_aug': self.batch_aug, 'tfms': repr(self.tfms)}
+        return _stats_key([file], mask=self.labels[file.name].attrs['cache_key'], **params, **kwargs)
+
+    def render_shards(self, path=None, n_samples=None, shard_size=64, seed=0, verbose=1, **kwargs):
+        "Renders `n_samples` augmented (tile, mask) pairs per image to compressed shards in `path`, returns a `ShardDataset` (`kwargs`) streaming them"
+        path = Path(path or self.preproc_dir/'shards')
+        n_samples = n_samples or self.sample_mult
+        msk_dtype = 'uint8' if self.c<=256 else 'int64'
+        for i, f in enumerate(self.files):
+            key = self._shard_key(f, n_samples=n_samples, shard_size=shard_size, seed=seed)
+            manifest_file = path/f.name/'manifest.json'
+            if manifest_file.exists() and json.loads(manifest_file.read_text())['key']==key:
+                if verbose>0: print('Using shards of', f.name)
+                continue
+            if verbose>0: print('Rendering shards of', f.name)
+            if manifest_file.exists(): shutil.rmtree(manifest_file.parent)
+            manifest_file.parent.mkdir(parents=True, exist_ok=True)
+            shards = []
+            # Samples of each file do not depend on the other files (e.g., of a fold)
+            with no_random(int(hashlib.md5(f'{seed}{f.name}'.encode()).hexdigest()[:8], 16), reproducible=False):
+                self.sampler.queues.pop(f.name, None)
+                for start in range(0, n_samples, shard_size):
+                    imgs, msks = zip(*[self[i] for _ in range(min(shard_size, n_samples-start))])
+                    shard = f'shard_{start//shard_size:05d}.npz'
+                    np.savez_compressed(path/f.name/shard, img=torch.stack(imgs).numpy(), msk=torch.stack(msks).numpy().astype(msk_dtype))
+                    shards.append((shard, len(imgs)))
+            # Manifests are written last, incomplete shards are rendered again
+            manifest_file.write_text(json.dumps({'key': key, 'shards': shards, 'batch_aug': self.batch_aug}))
+        return ShardDataset(path, self.files, source=self, **kwargs)
+
+# Cell
+def batch_augment(img, msk=None, tile_shape=(512,512), flip=True, rotation_range_deg=(0, 360), scale_range=(0, 0),
+                  gamma_limit=(80, 120), p_gamma=0.5, brightness_limit=(0, 0), contrast_limit=(0, 0), p_brightness_contrast=0.5, stats=None):
+    "Flip, rotate and scale crops `img` (N,C,H,W) or (N,C,D,H,W) and masks `msk` (N,H,W) or (N,D,H,W) to `tile_shape`, then apply intensity augmentations"
+    n, nd, device = img.shape[0], len(tile_shape), img.device
+    # Linear transform of the (row, col) tile grid as in `DeformationField`
+    mat = torch.eye(nd).repeat(n, 1, 1)
+    if flip:
+        dims = (torch.rand(n, 1) < float(flip)) & (torch.rand(n, nd) < 0.5)
+        mat = torch.where(dims, -1., 1.)[..., None] * mat
+    if rotation_range_deg[1] > rotation_range_deg[0]:
+        theta = torch.empty(n).uniform_(*rotation_range_deg) * math.pi / 180 * (torch.rand(n) < 0.5)
+        cos, sin = theta.cos(), theta.sin()
+        rot = torch.eye(nd).repeat(n, 1, 1)
+        rot[:, -2:, -2:] = torch.stack([torch.stack([cos, sin], -1), torch.stack([-sin, cos], -1)], 1)
+        mat = rot @ mat
+    if sum(scale_range)!=0:
+        mat = mat * torch.empty(n, 1, 1).uniform_(*scale_range)
+    # Normalized grid coordinates: output pixels span tile_shape, input pixels the crop shape
+    mat = mat * torch.tensor(tile_shape)[None, None] / torch.tensor(img.shape[2:])[None, :, None]
+    affine = torch.zeros(n, nd, nd+1)
+    affine[..., :nd] = mat.flip(1).flip(2) # (row, col) -> (x, y)
+    grid = F.affine_grid(affine.to(device=device, dtype=img.dtype), (n, 1, *tile_shape), align_corners=False)
+    img = F.grid_sample(img, grid, mode='bilinear', padding_mode='reflection', align_corners=False)
+    if msk is not None:
+        msk = F.grid_sample(msk[:, None].to(img.dtype), grid, mode='nearest', padding_mode='reflection', align_corners=False)
+        msk = msk[:, 0].long()
+
+    # Intensity augmentations, see albumentations RandomGamma and RandomBrightnessContrast
+    bshape = (-1,) + (1,)*(nd+1)
+    if p_gamma > 0:
+        gamma = torch.empty(n).uniform_(*gamma_limit) / 100
+        gamma = torch.where(torch.rand(n) < p_gamma, gamma, torch.ones(n))
+        img = img.clamp_min(0) ** gamma.to(img).view(bshape)
+    if p_brightness_contrast > 0 and any(brightness_limit+contrast_limit):
+        apply = torch.rand(n) < p_brightness_contrast
+        alpha = torch.where(apply, 1 + torch.empty(n).uniform_(*contrast_limit), torch.ones(n))
+        beta = torch.where(apply, torch.empty(n).uniform_(*brightness_limit), torch.zeros(n))
+        img = (img * alpha.to(img).view(bshape) + beta.to(img).view(bshape)).clamp(0, 1)
+    if stats is not None:
+        mean, std = [torch.as_tensor(np.array(s)).to(img).view(1, -1, *(1,)*nd) for s in stats]
+        img = (img - mean) / std
+    return img, msk
+
+# Cell
+class BatchAugmentation(Callback):
+    "Augments batches of raw crops from `RandomTileDataset(batch_aug=True)` on the device of the batch"
+    order = 0
+    def __init__(self, tile_shape=(512,512), flip=True, rotation_range_deg=(0, 360), scale_range=(0, 0), **kwargs):
+        store_attr('tile_shape, flip, rotation_range_deg, scale_range')
+        self.kwargs = kwargs
+
+    def before_batch(self):
+        if not getattr(self.dl.dataset, 'batch_aug', False): return
+        img, msk = batch_augment(self.xb[0], self.yb[0], tuple(self.tile_shape), self.flip, self.rotation_range_deg,
+                                 self.scale_range, **self.kwargs)
+        self.learn.xb, self.learn.yb = (img,), (msk,)
+
+# Cell
+class HardExampleSampler(Callback):
+    "Records the loss of training tiles per region and updates the sampling CDFs of `ds` every `update_every` iterations to favor high-loss regions"
+    order = -1 # Before `BatchAugmentation`
+    def __init__(self, ds, update_every=50, momentum=0.5, alpha=1., max_ratio=10.):
+        store_attr('ds, update_every, momentum, alpha, max_ratio')
+        self.base, self.losses, self.centers = {}, {}, None
+
+    def before_fit(self):
+        names = [f.name for f in self.ds.files]
+        # Items and CDFs of `ds` before fit, restored `after_fit`
+        self.state = self.ds.return_center, {name: self.ds.sampler._load(name)[0].copy() for name in names}
+        self.ds.sampler.share(names)
+        self.ds.return_center = True
+        for name in names:
+            if name in self.base: continue
+            cdf, shape = self.ds.sampler._load(name)
+            self.base[name] = np.diff(cdf, prepend=0).reshape(_pdf_shape(shape, self.ds.sampler.reshape))
+            # Loss per region of the sampling grid, NaN for regions without tiles
+            self.losses[name] = np.full(self.base[name].shape, np.nan)
+
+    def before_batch(self):
+        # Image indices and centers are not part of the targets
+        self.centers = None
+        if getattr(self.dl.dataset, 'return_center', False): self.centers, self.learn.yb = self.yb[-1], self.yb[:-1]
+
+    def after_loss(self):
+        if not self.training or self.centers is None: return
+        with torch.no_grad():
+            loss = F.cross_entropy(self.pred.float(), self.yb[0], reduction='none').flatten(1).mean(1)
+        for (i, *center), l in zip(self.centers.tolist(), loss.tolist()): self._record(self.ds.files[i].name, center, l)
+        if (self.train_iter+1)%self.update_every==0: self.update()
+
+    def _record(self, name, center, loss):
+        "Moving average of `loss` in the regions of the sampling grid covered by the tile at `center`"
+        losses, shape = self.losses[name], self.ds.sampler.shapes[name]
+        box = tuple(slice(max(int((c-t*self.ds.scale/2)*g/s), 0), int((c+t*self.ds.scale/2)*g/s)+1)
+                    for c, t, s, g in zip(center, self.ds.tile_shape, shape, losses.shape))
+        region = losses[box]
+        losses[box] = np.where(np.isnan(region), loss, self.momentum*region + (1-self.momentum)*loss)
+
+    def update(self):
+        "Weights the initial pdfs with the loss ratios (to the mean loss) of the regions"
+        for name, losses in self.losses.items():
+            seen = ~np.isnan(losses)
+            if not seen.any(): continue
+            ratio = np.ones_like(losses)
+            ratio[seen] = losses[seen]/max(losses[seen].mean(), 1e-8)
+            pdf = self.base[name]*np.clip(ratio, 1/self.max_ratio, self.max_ratio)**self.alpha
+            self.ds.sampler.update_cdf(name, np.cumsum(pdf/pdf.sum()))
+
+    def after_fit(self):
+        "Restores the items (without centers) and initial sampling CDFs of `ds`, the recorded losses are kept for the next fit"
+        return_center, cdfs = self.state
+        for name, cdf in cdfs.items(): self.ds.sampler.update_cdf(name, cdf)
+        self.ds.return_center = return_center
+
+# Cell
+class ShardDataset(IterableDataset):
+    "Streams pre-rendered (tile, mask) pairs of `files` from the shards in `path`, shuffled with a buffer of `buffer_size` tiles"
+    n_inp = 1
+    def __init__(self, path, files=None, buffer_size=512, shuffle=True, repeat=False, source=None):
+        self.path, self.buffer_size, self.shuffle, self.repeat, self.source = Path(path), buffer_size, shuffle, repeat, source
+        manifests = {m.parent.name: json.loads(m.read_text()) for m in sorted(self.path.glob('*/manifest.json'))}
+        names = [f.name for f in files] if files is not None else list(manifests)
+        missing = [n for n in names if n not in manifests]
+        assert not missing, f'No shards for {missing}, render them with `RandomTileDataset.render_shards`'
+        self.shards = [(self.path/n/s, c) for n in names for s, c in manifests[n]['shards']]
+        self.batch_aug = any(manifests[n]['batch_aug'] for n in names)
+        self.epoch = 0
+
+    def __len__(self):
+        return sum(c for _, c in self.shards)
+
+    def _items(self, seed, info=None):
+        "Tiles of the shards of this worker, in random shard order (repeated passes for `repeat`)"
+        for n_pass in itertools.count():
+            # All workers draw the same shard order and read disjoint shards
+            order = np.arange(len(self.shards))
+            if self.shuffle: order = np.random.RandomState((seed+n_pass)%2**32).permutation(order)
+            if info is not None: order = order[info.id::info.num_workers]
+            for i in order:
+                with np.load(self.shards[i][0]) as shard: yield from zip(shard['img'], shard['msk'])
+            if not self.repeat or len(order)==0: break
+
+    def __iter__(self):
+        info = get_worker_info()
+        # Seed of the epoch, shared by all workers (which count the epochs themselves if they are persistent)
+        seed = info.seed-info.id+self.epoch if info is not None else torch.randint(2**31, (1,)).item()
+        self.epoch += 1
+        rs, buffer = np.random.RandomState((seed-1-(info.id if info else 0))%2**32), []
+        for item in self._items(seed, info):
+            if not self.shuffle:
+                yield self._tensors(*item)
+                continue
+            buffer.append(item)
+            if len(buffer)>=self.buffer_size:
+                j = rs.randint(len(buffer))
+                buffer[j], buffer[-1] = buffer[-1], buffer[j]
+                yield self._tensors(*buffer.pop())
+        rs.shuffle(buffer)
+        for item in buffer: yield self._tensors(*item)
+
+    def _tensors(self, img, msk):
+        return torch.from_numpy(img), torch.from_numpy(msk.astype('int64'))
+
+    def batch_augmentation(self):
+        "`BatchAugmentation` callback of the `RandomTileDataset` that rendered the shards"
+        assert self.source is not None, 'Batch augmentation requires the source dataset'
+        return self.source.batch_augmentation()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({len(self.shards)} shards, {len(self)} tiles)'
+
+# Cell
+@functools.lru_cache(maxsize=None)
+def _tile_dtype(n_dims=2):
+    "Structured dtype of the tile index for images (`n_dims=2`) or volumes (`n_dims=3`)"
+    return np.dtype([('image', 'i4'), ('center', 'i4', n_dims), ('out_start', 'i4', n_dims), ('out_stop', 'i4', n_dims),
+                     ('in_start', 'i4', n_dims), ('in_stop', 'i4', n_dims), ('skip', '?')])
+
+def _tile_grid(data_shape, output_shape, scale=1, shift=1., bpf=0.25):
+    "Structured array with centers and output/input slice bounds of the tiles for an image of `data_shape`"
+    start_points = [o//2 - o*bpf for o in output_shape]
+    end_points = [(s - st) for s, st in zip(data_shape, start_points)]
+    n_points = [int((s+2*o*bpf)//(o*shift))+1 for s, o in zip(data_shape, output_shape)]
+    center_points = [np.linspace(st, e, num=n, endpoint=True, dtype=np.int64) for st, e, n in zip(start_points, end_points, n_points)]
+    # Tiles are ordered column by column
+    c = np.stack([x.ravel() for x in np.meshgrid(*center_points)], axis=1)
+    o, s = np.array(output_shape), np.array(data_shape)
+    tiles = np.zeros(len(c), dtype=_tile_dtype(len(data_shape)))
+    tiles['center'] = (c*scale).astype(int)
+    # Output slices for whole image and input slices for tile
+    tiles['out_start'] = np.clip(c - o/2, 0, s).astype(int)
+    tiles['out_stop'] = np.minimum(c + o/2, s).astype(int)
+    tiles['in_start'] = np.clip(o/2 - c, 0, None).astype(int)
+    tiles['in_stop'] = np.minimum(o, s - c + o/2).astype(int)
+    assert np.array_equal(tiles['in_stop']-tiles['in_start'], tiles['out_stop']-tiles['out_start']), 'Input/Output slices do not match'
+    return tiles
+
+# Cell
+def _foreground_map(img, threshold, block=16, chunk_rows=1024):
+    "Low resolution map of `block`x`block` regions in `img` (H,W,C) or (D,H,W,C) with an intensity above `threshold` in any channel"
+    chunk_rows = max(chunk_rows//block, 1)*block
+    rows = []
+    for r in range(0, img.shape[0], chunk_rows):
+        chunk = np.asarray(img[r:r+chunk_rows]).max(axis=-1)
+        pad = [(0, -s%block) for s in chunk.shape]
+        chunk = np.pad(chunk, pad, mode='edge')
+        blocks = [x for s in chunk.shape for x in (s//block, block)]
+        rows.append(chunk.reshape(blocks).max(axis=tuple(range(1, 2*chunk.ndim, 2))))
+    return np.concatenate(rows)>threshold
+
+# Cell
+def _background_tiles(tiles, fg, scale=1, block=16):
+    "Flags `tiles` without foreground in their output region, using the foreground map `fg`"
+    # Foreground blocks per region from the summed-area table (inclusion-exclusion over the region corners)
+    sat = fg
+    for ax in range(fg.ndim): sat = sat.cumsum(ax)
+    sat = np.pad(sat, [(1, 0)]*fg.ndim)
+    start = (tiles['out_start']*scale//block).astype(int)
+    stop = np.minimum(np.ceil(tiles['out_stop']*scale/block).astype(int), fg.shape)
+    n_fg = sum((-1)**(fg.ndim-sum(corner))*sat[tuple((stop if c else start)[:, i] for i, c in enumerate(corner))]
+               for corner in itertools.product((0, 1), repeat=fg.ndim))
+    return n_fg==0
+
 # Cell
 class TileDataset(BaseDataset):
     "Pytorch Dataset that creates random tiles for validation and prediction on new data."
     n_inp = 1
-    def __init__(self, *args, val_length=None, val_seed=42, is_zarr=False, shift=1., border_padding_factor=0.25, return_index=False, **kwargs):
+    def __init__(self, *args, val_length=None, val_seed=42, is_zarr=False, shift=1., border_padding_factor=0.25, return_index=False,
+                 lazy=True, img_cache_bytes=2**30, tile_index=None, fg_threshold=None, fg_block=16, **kwargs):
         super().__init__(*args, **kwargs)
         self.shift = shift
         self.bpf = border_padding_factor
+        self.fg_threshold, self.fg_block = fg_threshold, fg_block
         self.return_index = return_index
         self.output_shape = tuple(int(t - p) for (t, p) in zip(self.tile_shape, self.padding))
         self.tiler = DeformationField(self.tile_shape, scale=self.scale)
-        self.image_indices = []
-        self.image_shapes = []
-        self.in_slices = []
-        self.out_slices = []
-        self.centers = []
         self.valid_indices = None
 
         tfms = []
@@ -500,65 +1466,91 @@ class TileDataset(BaseDataset):
         if self.files[0].suffix == '.zarr' or is_zarr:
             self.data = zarr.open_group(self.files[0].parent.as_posix(), mode='r')
             is_zarr = True
+        elif lazy:
+            # Tiles are read from the source files (memory-mapped or decoded on first access)
+            self.img_cache = ImageCache(img_cache_bytes)
+            self.data = {f.name:LazyImage(f, self.read_img, self.img_cache, self.n_dims) for f in self.files}
         else:
             root = zarr.group(store=zarr.storage.TempStore(), overwrite=True)
             self.data = root.create_group('data')
 
-        j = 0
-        for i, file in enumerate(progress_bar(self.files, leave=False)):
-            img = self.read_img(file)
-            if not is_zarr: self.data[file.name] = img
-            # Tiling
-            data_shape = tuple(int(x//self.scale) for x in img.shape[:-1])
-            start_points = [o//2 - o*self.bpf for o in self.output_shape]
-            end_points = [(s - st) for s, st in zip(data_shape, start_points)]
-            n_points = [int((s+2*o*self.bpf)//(o*self.shift))+1 for s, o in zip(data_shape, self.output_shape)]
-            center_points = [np.linspace(st, e, num=n, endpoint=True, dtype=np.int64) for st, e, n in zip(start_points, end_points, n_points)]
-            for cx in center_points[1]:
-                for cy in center_points[0]:
-                    self.centers.append((int(cy*self.scale), int(cx*self.scale)))
-                    self.image_indices.append(i)
-                    self.image_shapes.append(data_shape)
-
-                    # Calculate output slices for whole image
-                    out_slice = tuple(slice(int((c - o/2).clip(0, s)), int((c + o/2).clip(max=s)))
-                                     for (c, o, s) in zip((cy, cx), self.output_shape, data_shape))
-                    self.out_slices.append(out_slice)
-
-                    # Calculate input slices for tile
-                    in_slice = tuple(slice(int((o/2-c).clip(0)), int(np.float64(o).clip(max=(s-c+o/2)))) for
-                                     (c, o, s) in zip((cy, cx), self.output_shape, data_shape))
-                    self.in_slices.append(in_slice)
-                    #assert img[in_slice].shape == img[out_slice].shape, 'Input/Output slices do not match'
-                    assert (in_slice[0].stop-in_slice[0].start) == (out_slice[0].stop-out_slice[0].start), 'Input/Output slices do not match'
-                    assert (in_slice[1].stop-in_slice[1].start) == (out_slice[1].stop-out_slice[1].start), 'Input/Output slices do not match'
-                    j += 1
+        if tile_index is not None:
+            self._load_tile_index(tile_index)
+            if not is_zarr and not lazy:
+                for file in progress_bar(self.files, leave=False): self.data[file.name] = self.read_img(file)
+        else:
+            data_shapes, tiles = [], []
+            for i, file in enumerate(progress_bar(self.files, leave=False)):
+                if not is_zarr and lazy:
+                    img_shape = _img_shape(file, self.n_dims)
+                else:
+                    img = self.read_img(file)
+                    if not is_zarr: self.data[file.name] = img
+                    img_shape = img.shape[:-1]
+                # Tiling
+                data_shape = tuple(int(x//self.scale) for x in img_shape)
+                data_shapes.append(data_shape)
+                tiles.append(_tile_grid(data_shape, self.output_shape, self.scale, self.shift, self.bpf))
+                tiles[-1]['image'] = i
+                if self.fg_threshold is not None:
+                    # Pre-screen for background tiles that can be skipped during prediction
+                    fg = _foreground_map(self.data[file.name], self.fg_threshold, self.fg_block)
+                    tiles[-1]['skip'] = _background_tiles(tiles[-1], fg, self.scale, self.fg_block)
+            self.data_shapes = np.array(data_shapes, dtype='i4')
+            self.tiles = np.concatenate(tiles)
 
         if val_length:
-            if val_length>len(self.image_shapes):
-                print(f'Reducing validation from lenght {val_length} to {len(self.image_shapes)}')
-                val_length = len(self.image_shapes)
+            if val_length>len(self.tiles):
+                print(f'Reducing validation from lenght {val_length} to {len(self.tiles)}')
+                val_length = len(self.tiles)
             rs = np.random.RandomState(val_seed)
-            choice = rs.choice(len(self.image_indices), val_length, replace=False)
-            self.valid_indices = {i:idx for i, idx in  enumerate(choice)}
+            self.valid_indices = rs.choice(len(self.tiles), val_length, replace=False)
+
+    @property
+    def _tiling_params(self):
+        return {'files': [f.name for f in self.files], 'output_shape': list(self.output_shape), 'scale': self.scale,
+                'shift': self.shift, 'border_padding_factor': self.bpf, 'fg_threshold': self.fg_threshold, 'fg_block': self.fg_block}
+
+    def save_tile_index(self, path):
+        "Saves the tile index to `path` (.npz) for reuse with `TileDataset(..., tile_index=path)`"
+        np.savez(path, tiles=self.tiles, data_shapes=self.data_shapes, params=json.dumps(self._tiling_params))
+
+    def _load_tile_index(self, path):
+        "Loads a tile index saved with `save_tile_index`"
+        with np.load(path) as index:
+            assert json.loads(str(index['params'])) == self._tiling_params, 'Tile index was created with different files or tiling parameters'
+            self.tiles, self.data_shapes = index['tiles'], index['data_shapes']
+
+    def init_worker(self, *args, **kwargs):
+        super().init_worker(*args, **kwargs)
+        # Forked file handles share their position with the main process
+        if isinstance(self.data, dict):
+            for img in self.data.values(): img.close()
+
+    @property
+    def image_indices(self): return self.tiles['image']
+
+    @property
+    def centers(self): return self.tiles['center']
 
     def __len__(self):
-        if self.valid_indices: return len(self.valid_indices)
-        else: return len(self.image_shapes)
+        if self.valid_indices is not None: return len(self.valid_indices)
+        else: return len(self.tiles)
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
-        if self.valid_indices: idx = self.valid_indices[idx]
-        img_path = self.files[self.image_indices[idx]]
+        if self.valid_indices is not None: idx = int(self.valid_indices[idx])
+        tile = self.tiles[idx]
+        img_path = self.files[tile['image']]
         img = self.data[img_path.name]
-        centerPos = self.centers[idx]
+        centerPos = tuple(tile['center'].tolist())
 
         img = self.tiler.apply(img, centerPos)
-        aug = self.tfms(image=img)
+        aug = _apply_tfms(self.tfms, img)
 
         if self.label_fn is not None:
-            msk = self.labels[img_path.name]
+            msk = self._zarr(('labels', img_path.name))
             msk = self.tiler.apply(msk, centerPos).astype('int64')
             return  aug['image'], msk
 
@@ -568,13 +1560,75 @@ class TileDataset(BaseDataset):
             else:
                 return aug['image']
 
+    def get_slices(self, idx):
+        "Returns output (whole image) and input (tile) slices of tile `idx`"
+        tile = self.tiles[int(idx)]
+        out_slice = tuple(slice(a, b) for a, b in zip(tile['out_start'].tolist(), tile['out_stop'].tolist()))
+        in_slice = tuple(slice(a, b) for a, b in zip(tile['in_start'].tolist(), tile['in_stop'].tolist()))
+        return out_slice, in_slice
+
     def get_tile_info(self, idx):
         'Returns dict containing information for image reconstruction'
-
+        out_idx = int(self.tiles[int(idx)]['image'])
+        out_slice, in_slice = self.get_slices(idx)
         return {
-            'out_idx' : self.image_indices[idx],
-            'out_name' : self.files[self.image_indices[idx]].name,
-            'out_shape' : self.image_shapes[idx],
-            'out_slice' : self.out_slices[idx],
-            'in_slice' : self.in_slices[idx]
-        }
\ No newline at end of file
+            'out_idx' : out_idx,
+            'out_name' : self.files[out_idx].name,
+            'out_shape' : tuple(self.data_shapes[out_idx].tolist()),
+            'out_slice' : out_slice,
+            'in_slice' : in_slice
+        }
+
+# Cell
+def worker_init_fn(worker_id=None):
+    "Calls `init_worker` of the dataset in a DataLoader worker (`worker_init_fn` of PyTorch or `wif` of fastai DataLoaders)"
+    info = get_worker_info()
+    if info is None: return
+    # fastai runs a `_FakeLoader` of the DataLoader (`d`) in the workers
+    ds = getattr(info.dataset, 'd', info.dataset)
+    while not hasattr(ds, 'init_worker') and hasattr(ds, 'dataset'): ds = ds.dataset
+    if hasattr(ds, 'init_worker'): ds.init_worker(info.id, info.num_workers)
+
+# Cell
+class PersistentDL(TfmdDL):
+    "`TfmdDL` that keeps its workers (`persistent_workers=True`) and their dataset copies alive between epochs"
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Seed of the epoch, shared with the workers
+        self._seed, self._it = torch.zeros(1, dtype=torch.int64).share_memory_(), None
+
+    @property
+    def _persistent(self): return self.fake_l.persistent_workers and self.fake_l.num_workers>0
+
+    def sample(self):
+        # Persistent workers draw the (shuffled) indices of each epoch themselves
+        if self._persistent and get_worker_info() is not None:
+            self.rng = random.Random(self._seed.item())
+            self._DataLoader__idxs = self.get_idxs()
+        return super().sample()
+
+    def __iter__(self):
+        if not self._persistent:
+            yield from super().__iter__()
+            return
+        self.randomize()
+        self.before_iter()
+        self._seed.fill_(self.rng.randint(0, 2**62))
+        if self._it is None: self._it = _MultiProcessingDataLoaderIter(self.fake_l)
+        else: self._it._reset(self.fake_l)
+        for b in self._it:
+            # pin_memory causes tuples to be converted to lists, so convert them back to tuples
+            if self.pin_memory and type(b) == list: b = tuple(b)
+            if self.device is not None: b = to_device(b, self.device)
+            yield self.after_batch(b)
+        self.after_iter()
+        if hasattr(self, 'it'): del(self.it)
+
+    def shutdown(self):
+        "Stops the persistent workers, the next iteration starts new workers"
+        if self._it is not None: self._it._shutdown_workers()
+        self._it = None
+
+    def __getstate__(self):
+        # Workers are not copied
+        return {**self.__dict__, '_it': None}
\ No newline at end of file
@@ -3,11 +3,14 @@
 __all__ = ['Config', 'energy_score', 'EnsemblePredict', 'EnsembleLearner']
 
 # Cell
-import shutil, gc, joblib, json, zarr, numpy as np, pandas as pd
+import os, shutil, gc, joblib, json, zarr, time, queue, threading, numpy as np, pandas as pd
 import torch, torch.nn as nn, torch.nn.functional as F
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from dataclasses import dataclass, field, asdict
 from pathlib import Path
+from functools import partial
+from contextlib import ExitStack
+from copy import deepcopy
 
 from sklearn import svm
 from sklearn.model_selection import KFold
@@ -21,7 +24,7 @@ from fastcore.basics import patch, GetAttr
 from fastcore.foundation import add_docs, L
 from fastai import optimizer
 from fastai.torch_core import TensorImage
-from fastai.learner import Learner
+from fastai.learner import Learner, Recorder
 from fastai.callback.tracker import SaveModelCallback
 from fastai.data.core import DataLoaders
 from fastai.data.transforms import get_image_files, get_files
@@ -31,7 +34,7 @@ from fastai.losses import CrossEntropyLossFlat
 from .metrics import Dice, Iou
 from .losses import get_loss
 from .models import create_smp_model, save_smp_model, load_smp_model
-from .data import TileDataset, RandomTileDataset, _read_img, _read_msk
+from .data import TileDataset, RandomTileDataset, PersistentDL, worker_init_fn, _read_img, _read_msk
 from .utils import iou, plot_results, get_label_fn, calc_iterations, save_mask, save_unc, export_roi_set
 from .utils import compose_albumentations as _compose_albumentations
 import deepflash2.tta as tta
@@ -62,6 +65,7 @@ class Config:
     # Train Data Settings
     c:int = 2
     tile_shape:int = 512
+    tile_depth:int = 0 # Prediction of volumes (z-stacks) with tiles of tile_depth slices (0 = 2D images)
     il:bool = False
 
     # Train Settings
@@ -73,11 +77,17 @@ class Config:
     loss:str = 'CrossEntropyDiceLoss'
     n_iter:int = 2000
     sample_mult:int = 0
+    hard_examples:bool = False # Sample more tiles from high-loss regions during training (see HardExampleSampler)
+    shards:int = 0 # Pre-render shards of augmented training tiles (number per image) that are streamed in each epoch (0 = off)
+    shard_buffer:int = 512
+    persistent_workers:bool = True # Keep the DataLoader workers (and their caches) alive between epochs
+    prefetch_factor:int = 2 # Batches loaded in advance by each DataLoader worker
 
     # Validation and Prediction Settings
     tta:bool = True
     border_padding_factor:float = 0.25
     shift:float = 0.5
+    fg_threshold:float = 0. # Skip prediction of tiles without intensities above threshold (0 = off)
 
     # Train Data Augmentation
     gamma_limit_lower:int = 80
@@ -88,6 +98,7 @@ class Config:
     flip:bool = True
     rot:int = 360
     distort_limit:float = 0
+    batch_aug:bool = False # Warp and augment batches on device (no CLAHE or GridDistortion)
 
     # Loss Settings
     mode:str = 'multiclass' #currently only tested for multiclass
@@ -99,6 +110,10 @@ class Config:
     # Pred Settings
     pred_tta:bool = True
     min_pixel_export:int = 0
+    inference_mode:bool = True # torch.inference_mode instead of torch.no_grad
+    channels_last:bool = False # Channels-last memory format of models and tiles
+    bf16:bool = False # bfloat16 autocast
+    compile_models:str = '' # 'trace' (torch.jit.trace) or 'compile' (torch.compile), falls back to eager models ('' = off)
 
     # Folder Structure
     gt_dir:str = 'GT_Estimation'
@@ -114,6 +129,11 @@ class Config:
                   'brightness_limit', 'contrast_limit', 'distort_limit']
         return dict(filter(lambda x: x[0] in kwargs, self.__dict__.items()))
 
+    @property
+    def inference_kwargs(self):
+        kwargs = ['inference_mode', 'channels_last', 'bf16', 'compile_models']
+        return dict(filter(lambda x: x[0] in kwargs, self.__dict__.items()))
+
     @property
     def svm_kwargs(self):
         svm_vars = ['kernel', 'nu', 'gamma']
@@ -171,13 +191,296 @@ def energy_score(x, T=1, dim=1):
     'Return the energy score as proposed by  Liu, Weitang, et al. (2020).'
     return -(T*torch.logsumexp(x/T, dim=dim))
 
+# Cell
+def _forward(model, x, call=None):
+    "Forward pass of tiles (N,C,H,W) or volume tiles (N,C,D,H,W), `call` replaces `model(x)` (e.g., functional calls)"
+    call = call or model
+    # 3D models take volume tiles, 2D models predict each slice from `in_channels//C` neighbouring slices (2.5D)
+    if x.ndim==4 or getattr(model, 'n_dims', 2)==3: return call(x)
+    n, c, d, h, w = x.shape
+    k = getattr(model, 'kwargs', {}).get('in_channels', c)//c
+    assert k%2==1, '2.5D models require an odd number of input slices'
+    if k>1: x = F.pad(x, (0, 0, 0, 0, k//2, k//2), mode='replicate')
+    x = x.unfold(2, k, 1).permute(0, 2, 5, 1, 3, 4).reshape(n*d, k*c, h, w)
+    out = call(x)
+    return out.view(n, d, *out.shape[1:]).transpose(1, 2)
+
+# Cell
+class _StackedModels:
+    "Runs models of the same architecture as one vectorized model (`torch.func.vmap`), outputs are stacked along the first axis"
+    def __init__(self, models):
+        assert hasattr(torch, 'func'), 'Stacking models requires torch>=2.0'
+        shapes = [[(n, p.shape) for n, p in m.state_dict().items()] for m in models]
+        assert all(type(m)==type(models[0]) and s==shapes[0] for m, s in zip(models, shapes)), 'Only models of the same architecture can be stacked'
+        self.params, self.buffers = torch.func.stack_module_state(models)
+        # Parameters and buffers are replaced in each call
+        self.base = deepcopy(models[0]).to('meta')
+
+    def _call(self, params, buffers, x):
+        return _forward(self.base, x, partial(torch.func.functional_call, self.base, (params, buffers)))
+
+    def __call__(self, x):
+        return torch.vmap(self._call, in_dims=(0, 0, None))(self.params, self.buffers, x)
+
+# Cell
+class _InferenceModel:
+    "Calls `model` with channels-last inputs (`channels_last`) and traced (`compile_models='trace'`) or compiled (`'compile'`), falls back to the eager model"
+    def __init__(self, model, channels_last=False, compile_models=None):
+        self.model, self.channels_last, self.compile_models, self.fn = model, channels_last, compile_models, None
+        if not compile_models: self.fn = model
+        else: assert compile_models in ('trace', 'compile'), "`compile_models` must be 'trace' or 'compile'"
+
+    def _compile(self, x):
+        "Traces or compiles the model on the first input"
+        try:
+            if self.compile_models=='trace': fn = torch.jit.trace(self.model, x, check_trace=False)
+            else: fn = torch.compile(self.model)
+            # Compilation errors are raised in the first call
+            fn(x)
+            self.fn = fn
+        except Exception as e:
+            print(f'Model {self.compile_models} is not available ({type(e).__name__}: {e}), using the eager model')
+            self.fn = self.model
+
+    def __call__(self, x):
+        if self.channels_last: x = x.contiguous(memory_format=torch.channels_last if x.ndim==4 else torch.channels_last_3d)
+        if self.fn is None: self._compile(x)
+        return self.fn(x)
+
+# Cell
+def _prefetch(it, maxsize=2, stats=None, threaded=True):
+    "Iterates `it` in a background thread with a bounded queue of `maxsize` items, time spent in `it` is added to `stats['load']`"
+    stats = stats if stats is not None else {'load': 0.}
+    def _timed():
+        it_ = iter(it)
+        while True:
+            start = time.perf_counter()
+            try: x = next(it_)
+            except StopIteration: return
+            finally: stats['load'] += time.perf_counter()-start
+            yield x
+    if not threaded:
+        yield from _timed()
+        return
+    q, done, stop = queue.Queue(maxsize), object(), threading.Event()
+    def _put(x):
+        # Gives up if the consumer exits early
+        while not stop.is_set():
+            try: return q.put(x, timeout=0.1) or True
+            except queue.Full: pass
+        return False
+    def _run():
+        try:
+            for x in _timed():
+                if not _put(x): return
+            _put(done)
+        except Exception as e: _put(e)
+    thread = threading.Thread(target=_run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            x = q.get()
+            if x is done: break
+            if isinstance(x, Exception): raise x
+            yield x
+    finally:
+        stop.set()
+        thread.join()
+
+# Cell
+class _Consumer:
+    "Calls `fn` on the items of a bounded queue (`maxsize`) in a background thread, time spent in `fn` is kept in `time`"
+    def __init__(self, fn, maxsize=2, threaded=True):
+        self.fn, self.threaded, self.time, self.error = fn, threaded, 0., None
+        if threaded:
+            self.q = queue.Queue(maxsize)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _call(self, args):
+        start = time.perf_counter()
+        try: self.fn(*args)
+        finally: self.time += time.perf_counter()-start
+
+    def _run(self):
+        while True:
+            args = self.q.get()
+            if args is None: break
+            # Remaining items are dropped after an error
+            if self.error is None:
+                try: self._call(args)
+                except Exception as e: self.error = e
+
+    def put(self, *args):
+        if not self.threaded: return self._call(args)
+        if self.error is not None: raise self.error
+        self.q.put(args)
+
+    def close(self):
+        "Waits for the remaining items, errors of `fn` are raised here"
+        if self.threaded:
+            self.q.put(None)
+            self.thread.join()
+        if self.error is not None: raise self.error
+
+# Cell
+class _TileAccumulator:
+    "Weighted sums of the tile outputs and weights of `image` on `device` (`rows`: window of the first rows), each batch is added with `index_add_`"
+    def __init__(self, ds, mw, uncertainty_estimates=True, device='cpu', rows=None, image=0):
+        self.tiles, self.device, self.c = ds.tiles, device, ds.c
+        self.tile_shape = tuple(int(o) for o in ds.output_shape)
+        self.data_shape = tuple(int(s) for s in ds.data_shapes[image])
+        self.keys = ['softmax', 'merge_map'] + (['stdeviation', 'energy'] if uncertainty_estimates else [])
+        self.mw = mw.flatten().to(device)
+        # Padded to the unclipped tile outputs, tiles are added as a whole and the borders are cropped
+        tiles = ds.tiles[ds.tiles['image']==image]
+        starts = tiles['out_start'] - tiles['in_start']
+        self.pad = np.maximum(-starts.min(0), 0)
+        pad_end = np.maximum((starts+np.array(self.tile_shape)).max(0)-self.data_shape, 0)
+        shape = tuple(int(s) for s in self.data_shape+self.pad+pad_end)
+        self.sums = {}
+        self._allocate(shape if rows is None else (rows, *shape[1:]))
+
+    def _allocate(self, shape):
+        "Allocates flat sums for `shape` (keeping existing sums) and the flat offsets of the tile pixels"
+        n = int(np.prod(shape))
+        for k in self.keys:
+            x = torch.zeros(n, *((self.c,) if k=='softmax' else ()), device=self.device)
+            if k in self.sums: x[:min(n, len(self.sums[k]))] = self.sums[k][:n]
+            self.sums[k] = x
+        self.shape = shape
+        self.strides = np.cumprod((*shape[1:], 1)[::-1])[::-1]
+        grid = np.stack(np.meshgrid(*[np.arange(o) for o in self.tile_shape], indexing='ij'), -1).reshape(-1, len(shape))
+        self.offsets = torch.from_numpy(grid@self.strides).to(self.device)
+
+    def _add(self, starts, smx, std, eng):
+        "Adds the weighted outputs `smx` (N,C,...), `std` and `eng` (N,...) of tiles starting at `starts` (accumulator coordinates)"
+        index = (torch.from_numpy(starts@self.strides).to(self.device)[:, None] + self.offsets).flatten()
+        self.sums['softmax'].index_add_(0, index, smx.to(self.device).movedim(1, -1).reshape(-1, self.c))
+        self.sums['merge_map'].index_add_(0, index, self.mw.repeat(len(starts)))
+        for k, x in (('stdeviation', std), ('energy', eng)):
+            if k in self.sums: self.sums[k].index_add_(0, index, x.to(self.device).flatten())
+
+    def add(self, smx, std, eng, idxs):
+        "Adds the outputs of the tiles `idxs`"
+        tiles = self.tiles[np.asarray(idxs)]
+        # Unclipped start of the tile outputs
+        self._add(tiles['out_start'] - tiles['in_start'] + self.pad, smx, std, eng)
+
+    def _normalized(self, crop):
+        "Normalized softmax, uncertainty and energy (NumPy arrays) of `crop`, regions without tiles are background with zero uncertainty"
+        merge_map = self.sums['merge_map'].view(self.shape)[crop]
+        background = merge_map==0
+        merge_map = merge_map.masked_fill(background, 1.)
+        softmax = self.sums['softmax'].view(*self.shape, -1)[crop]/merge_map[..., None]
+        softmax[..., 0].masked_fill_(background, 1.)
+        out = [softmax] + [self.sums[k].view(self.shape)[crop]/merge_map if k in self.sums else None for k in ('stdeviation', 'energy')]
+        return tuple(x.cpu().numpy() if x is not None else None for x in out)
+
+    def result(self):
+        # Single transfer to the host
+        return self._normalized(tuple(slice(p, p+s) for p, s in zip(self.pad, self.data_shape)))
+
+# Cell
+class _BandAccumulator(_TileAccumulator):
+    "Sums tiles added in raster order in a window of rows, finished rows are written to the zarr arrays `out` (softmax, std, energy)"
+    def __init__(self, ds, mw, uncertainty_estimates=True, device='cpu', out=None):
+        # Window of two tile rows, grows if a batch spans more rows
+        super().__init__(ds, mw, uncertainty_estimates, device, rows=2*int(ds.output_shape[0]))
+        self.out = out
+        # Padded row of the first window row and image rows written to `out`
+        self.lo, self.done = 0, 0
+
+    def _write(self, start, stop, data):
+        for arr, x in zip(self.out, data):
+            if arr is not None and x is not None: arr[start:stop] = x
+
+    def _flush(self, stop):
+        "Writes the image rows before `stop` (in whole chunks, except for the last rows) and moves the window"
+        if stop<self.data_shape[0]: stop = stop//self.out[0].chunks[0]*self.out[0].chunks[0]
+        stop = min(stop, self.data_shape[0])
+        if stop<=self.done: return
+        p0, row = int(self.pad[0]), int(np.prod(self.shape[1:]))
+        # Rows in the window, rows after the window were not covered by any tile
+        n = min(stop+p0-self.lo, self.shape[0])
+        window_stop = max(self.lo+n-p0, self.done)
+        crop = (slice(self.done+p0-self.lo, window_stop+p0-self.lo),) + tuple(slice(p, p+s) for p, s in zip(self.pad[1:], self.data_shape[1:]))
+        self._write(self.done, window_stop, self._normalized(crop))
+        for start in range(window_stop, stop, self.out[0].chunks[0]):
+            end = min(start+self.out[0].chunks[0], stop)
+            bg = np.zeros((end-start, *self.data_shape[1:]), dtype='float32')
+            softmax = np.zeros((*bg.shape, self.c), dtype='float32')
+            softmax[..., 0] = 1.
+            self._write(start, end, (softmax, bg, bg))
+        # Finished rows are dropped from the window
+        for x in self.sums.values():
+            x[:len(x)-n*row] = x[n*row:].clone()
+            x[len(x)-n*row:] = 0
+        self.lo, self.done = stop+p0, stop
+
+    def add(self, smx, std, eng, idxs):
+        tiles = self.tiles[np.asarray(idxs)]
+        starts = tiles['out_start'] - tiles['in_start'] + self.pad
+        # Rows before the first tile of the batch are finished
+        self._flush(int(starts[:, 0].min()-self.pad[0]))
+        starts[:, 0] -= self.lo
+        rows = int(starts[:, 0].max())+self.tile_shape[0]
+        if rows>self.shape[0]: self._allocate((rows, *self.shape[1:]))
+        self._add(starts, smx, std, eng)
+
+    def result(self):
+        "Writes the remaining rows, returns `out`"
+        self._flush(self.data_shape[0])
+        return self.out
+
+# Cell
+class _ImageAccumulators:
+    "Accumulators for batches with tiles of several images, each image is written to the zarr groups `out` (softmax, std, energy) after its last tile in `idxs`"
+    def __init__(self, ds, mw, uncertainty_estimates=True, device='cpu', out=None, idxs=None):
+        self.ds, self.mw, self.uncertainty_estimates, self.device, self.out = ds, mw, uncertainty_estimates, device, out
+        idxs = np.arange(len(ds.tiles)) if idxs is None else idxs
+        self.remaining = np.bincount(ds.tiles['image'][idxs], minlength=len(ds.files))
+        self.accs, self.written = {}, set()
+
+    def _write(self, i):
+        "Writes the results of image `i` (background if no tiles were added), chunked like the tile outputs"
+        acc = self.accs.pop(i, None) or _TileAccumulator(self.ds, self.mw, self.uncertainty_estimates, self.device, image=i)
+        res = acc.result()
+        chunks = tuple(min(o, s) for o, s in zip(self.ds.output_shape, res[0].shape))
+        for g, x in zip(self.out, res):
+            if g is not None and x is not None: g.array(self.ds.files[i].name, x, chunks=(*chunks, self.ds.c)[:x.ndim], overwrite=True)
+        self.written.add(i)
+
+    def add(self, smx, std, eng, idxs):
+        idxs = np.asarray(idxs)
+        images = self.ds.tiles['image'][idxs]
+        for i in np.unique(images):
+            m = np.flatnonzero(images==i)
+            if i not in self.accs: self.accs[i] = _TileAccumulator(self.ds, self.mw, self.uncertainty_estimates, self.device, image=i)
+            if len(m)<len(idxs):
+                sel = torch.from_numpy(m).to(smx.device)
+                self.accs[i].add(*[x.index_select(0, sel) if x is not None else None for x in (smx, std, eng)], idxs[m])
+            else: self.accs[i].add(smx, std, eng, idxs)
+            self.remaining[i] -= len(m)
+            # Last tile of the image
+            if self.remaining[i]==0: self._write(i)
+
+    def result(self):
+        "Writes the images without predicted tiles, returns `out`"
+        for i in range(len(self.ds.files)):
+            if i not in self.written: self._write(i)
+        return self.out
+
 # Cell
 class EnsemblePredict():
     'Class for prediction with multiple models'
-    def __init__(self, models_paths, zarr_store=None):
+    def __init__(self, models_paths, zarr_store=None, inference_mode=True, channels_last=False, bf16=False, compile_models=None):
         self.models_paths = models_paths
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        # Inference backend (see `_inference_context` and `_InferenceModel`)
+        self.inference_mode, self.channels_last, self.bf16, self.compile_models = inference_mode, channels_last, bf16, compile_models
         self.init_models()
+        self.skip_stats = {}
 
         # Init zarr storage
         self.store = str(zarr_store) if zarr_store else zarr.storage.TempStore()
@@ -196,7 +499,38 @@ class EnsemblePredict():
             model.float()
             model.eval()
             model.to(self.device)
+            if self.channels_last:
+                model.to(memory_format=torch.channels_last_3d if getattr(model, 'n_dims', 2)==3 else torch.channels_last)
             self.models.append(model)
+        self._stacked = None
+        self._calls = [_InferenceModel(m, self.channels_last, self.compile_models) for m in self.models]
+
+    def _inference_context(self):
+        "`torch.inference_mode` (or `torch.no_grad`) and bfloat16 autocast if `bf16` (if available on the device)"
+        ctx = [torch.inference_mode() if self.inference_mode and hasattr(torch, 'inference_mode') else torch.no_grad()]
+        if self.bf16:
+            if hasattr(torch, 'autocast') and (self.device.type=='cpu' or torch.cuda.is_bf16_supported()):
+                ctx.append(torch.autocast(self.device.type, dtype=torch.bfloat16))
+            else: print('bfloat16 autocast is not available, using float32')
+        return ctx
+
+    def _logits(self, tiles, tfms, fused=True, stack_models=False):
+        "De-augmented logits (TTA variants x models, N, C, ...) of `tiles` for the test-time augmentations `tfms`"
+        transforms = list(tta.Compose(tfms))
+        with ExitStack() as stack:
+            for ctx in self._inference_context(): stack.enter_context(ctx)
+            if not fused:
+                out = torch.stack([t.deaugment_mask(_forward(m, t.augment_image(tiles), c)) for t in transforms for m, c in zip(self.models, self._calls)])
+                return out.float()
+            # Each model (or the stacked models) predicts all TTA variants of the batch at once
+            x = torch.cat([t.augment_image(tiles) for t in transforms])
+            if stack_models and len(self.models)>1:
+                if self._stacked is None: self._stacked = _StackedModels(self.models)
+                out = self._stacked(x)
+            else: out = torch.stack([_forward(m, x, c) for m, c in zip(self.models, self._calls)])
+            out = out.float().view(len(self.models), len(transforms), len(tiles), *out.shape[2:])
+            # De-augmentation of each TTA variant for all models
+            return torch.cat([t.deaugment_mask(out[:, i]) for i, t in enumerate(transforms)])
 
     def predict(self,
                 ds,
@@ -206,6 +540,13 @@ class EnsemblePredict():
                 sigma_scale=1./8,
                 uncertainty_estimates=True,
                 energy_T = 1.,
+                num_workers=None,
+                prefetch_factor=2,
+                fused=True,
+                stack_models=False,
+                pipeline=True,
+                queue_size=2,
+                out=None,
                 verbose=0):
 
         if verbose>0: print('Ensemble prediction with models:', self.models_paths)
@@ -213,93 +554,140 @@ class EnsemblePredict():
         tfms = [tta.HorizontalFlip(),tta.VerticalFlip()] if use_tta else []
         if verbose>0: print('Using Test-Time Augmentation with:', tfms)
 
-        dl = DataLoader(ds, bs, num_workers=0, shuffle=False, pin_memory=True)
-
-        # Create zero arrays
-        data_shape = ds.image_shapes[0]
-        softmax = np.zeros((*data_shape, ds.c), dtype='float32')
-        merge_map = np.zeros(data_shape, dtype='float32')
-        stdeviation = np.zeros(data_shape, dtype='float32') if uncertainty_estimates else None
-        energy = np.zeros(data_shape, dtype='float32') if uncertainty_estimates else None
+        # Background tiles flagged by the foreground pre-screen of the dataset are not predicted
+        skip = ds.tiles['skip'] if ds.valid_indices is None else np.zeros(len(ds), dtype=bool)
+        tile_ds = Subset(ds, np.flatnonzero(~skip)) if skip.any() else ds
+        if len(ds.files)>1:
+            # Several images: one tile stream, each image is written to the zarr groups `out` after its last tile
+            assert out is not None and ds.valid_indices is None, 'Datasets with several images require zarr groups `out`'
+        elif out is not None:
+            # Streaming: tiles in raster order (rows first), finished rows are written to `out`
+            assert ds.valid_indices is None, 'Streaming requires all tiles of the image'
+            tile_idx = np.flatnonzero(~skip)
+            starts = ds.tiles['out_start'][tile_idx] - ds.tiles['in_start'][tile_idx]
+            tile_ds = Subset(ds, tile_idx[np.lexsort(starts.T[::-1])])
+        # Workers (default: up to 4) are only started for more than one batch
+        num_workers = min(num_workers if num_workers is not None else min(4, os.cpu_count()), len(tile_ds)//bs)
+        dl = DataLoader(tile_ds, bs, num_workers=num_workers, shuffle=False, pin_memory=True, worker_init_fn=worker_init_fn,
+                        prefetch_factor=prefetch_factor if num_workers>0 else None)
+        start_time = time.perf_counter()
 
         # Define merge weights
         if use_gaussian:
             mw_numpy = _get_gaussian(ds.output_shape, sigma_scale)
         else:
-            mw_numpy = np.ones(dl.output_shape)
+            mw_numpy = np.ones(ds.output_shape, dtype='float32')
         mw = torch.from_numpy(mw_numpy).to(self.device)
 
+        # Weighted sums of the tiles on the compute device (on the host if they take more than half of the free GPU memory)
+        acc_device = self.device
+        if acc_device.type=='cuda':
+            nbytes = np.prod(ds.data_shapes.max(0)+np.array(ds.output_shape))*(ds.c+3)*4
+            if nbytes>torch.cuda.mem_get_info(acc_device)[0]//2: acc_device = torch.device('cpu')
+        if len(ds.files)>1: acc = _ImageAccumulators(ds, mw, uncertainty_estimates, acc_device, out=out, idxs=np.flatnonzero(~skip))
+        elif out is not None: acc = _BandAccumulator(ds, mw, uncertainty_estimates, acc_device, out=out)
+        else: acc = _TileAccumulator(ds, mw, uncertainty_estimates, acc_device)
+
+        # Pipeline: tiles are loaded (producer) and stitched (consumer) in background threads during the forward passes
+        stats = {'load': 0., 'compute': 0.}
+        stitcher = _Consumer(acc.add, queue_size, threaded=pipeline)
         # Loop over tiles (indices required!)
-        for tiles, idxs in iter(dl):
+        for tiles, idxs in _prefetch(dl, queue_size, stats, threaded=pipeline):
+            compute_start = time.perf_counter()
             tiles = tiles.to(self.device)
-            smx_merger = tta.Merger()
-            if uncertainty_estimates:
-                energy_merger = tta.Merger()
-
-            # Loop over tt-augmentations
-            for t in tta.Compose(tfms):
-                aug_tiles = t.augment_image(tiles)
-                model_merger = tta.Merger()
-                if uncertainty_estimates: engergy_list = []
-
-                # Loop over models
-                for model in self.models:
-                    with torch.no_grad():
-                        logits = model(aug_tiles)
-                    logits = t.deaugment_mask(logits)
-                    smx_merger.append(F.softmax(logits, dim=1))
-                    if uncertainty_estimates:
-                        energy_merger.append(-energy_score(logits, energy_T)) #negative energy score
-
-            out_list = []
-            # Apply gaussian weigthing
-            batch_smx = smx_merger.result()*mw.view(1,1,*mw.shape)
-            # Reshape and append to list
-            out_list.append([x for x in batch_smx.permute(0,2,3,1).cpu().numpy()])
+            # Logits of all tt-augmentations and models
+            logits = self._logits(tiles, tfms, fused, stack_models)
+            smx = F.softmax(logits, dim=2)
 
+            # Apply gaussian weigthing
+            batch_smx = smx.mean(0)*mw.view(1,1,*mw.shape)
+            batch_std, batch_energy = None, None
             if uncertainty_estimates:
-                batch_std = torch.mean(smx_merger.result('std'), dim=1)*mw.view(1,*mw.shape)
-                out_list.append([x for x in batch_std.cpu().numpy()])
-
-                batch_energy =  energy_merger.result()*mw.view(1,*mw.shape)
-                out_list.append([x for x in batch_energy.cpu().numpy()])
-
-            # Compose predictions
-            for preds in zip(*out_list, idxs):
-                if uncertainty_estimates: smx,std,eng,idx = preds
-                else: smx, idx = preds
-                out_slice = ds.out_slices[idx]
-                in_slice = ds.in_slices[idx]
-                softmax[out_slice] += smx[in_slice]
-                merge_map[out_slice] += mw_numpy[in_slice]
-
-                if uncertainty_estimates:
-                    stdeviation[out_slice] += std[in_slice]
-                    energy[out_slice] += eng[in_slice]
-
-        # Normalize weighting
-        softmax /= merge_map[..., np.newaxis]
-        if uncertainty_estimates:
-            energy /= merge_map
-            stdeviation /= merge_map
+                batch_std = torch.mean(smx.std(0), dim=1)*mw.view(1,*mw.shape)
+                #negative energy score
+                batch_energy =  (-energy_score(logits, energy_T, dim=2)).mean(0)*mw.view(1,*mw.shape)
+
+            stats['compute'] += time.perf_counter()-compute_start
+            stitcher.put(batch_smx, batch_std, batch_energy, idxs)
+        stitcher.close()
+
+        # Busy time of each stage, the stages overlap if `pipeline`
+        n_skipped, n_pred = int(skip.sum()), len(tile_ds)
+        total = time.perf_counter()-start_time
+        self.pipeline_stats = {**stats, 'stitch': stitcher.time, 'total': total, 'tiles_per_sec': n_pred/total}
+        if verbose>1: print('Pipeline stages (s):', {k: round(v, 2) for k, v in self.pipeline_stats.items()})
+
+        # Skipped regions are background with zero uncertainty
+        self.tile_stats = {'skipped_tiles': n_skipped,
+                           'time_saved': total/max(n_pred, 1)*n_skipped}
+        if verbose>0 and n_skipped>0:
+            print(f"Skipped {n_skipped} of {len(skip)} background tiles (~{self.tile_stats['time_saved']:.1f}s saved)")
+
+        # Normalize weighting (written to `out` if streaming or for several images)
+        softmax, stdeviation, energy = acc.result()
 
         return softmax, stdeviation, energy
 
-    def predict_images(self, image_list, ds_kwargs={}, verbose=1, **kwargs):
-        "Predict images in 'image_list' with kwargs and save to zarr"
+    def predict_images(self, image_list, ds_kwargs={}, verbose=1, stream=False, multi_image=False, **kwargs):
+        "Predict images in 'image_list' with kwargs and save to zarr (`stream`: finished rows are written during prediction, `multi_image`: batches of tiles across images)"
+        if multi_image:
+            assert not stream, 'Streaming is only available for single images'
+            if verbose>0: print(f'Predicting {len(image_list)} images')
+            ds = TileDataset(image_list, stats=self.stats, return_index=True, **ds_kwargs)
+            self.predict(ds, out=(self.g_smx, self.g_std, self.g_eng), **kwargs)
+            # Skipped tiles and saved time of each image
+            n_skipped = np.bincount(ds.tiles['image'][ds.tiles['skip']], minlength=len(ds.files))
+            for f, n in zip(ds.files, n_skipped):
+                self.skip_stats[f.name] = {'skipped_tiles': int(n),
+                                           'time_saved': self.tile_stats['time_saved']*n/max(n_skipped.sum(), 1)}
+            if verbose>0: self._print_skipped([f.name for f in ds.files], len(ds.tiles))
+            return self.g_smx, self.g_std, self.g_eng
+
+        n_tiles = 0
         for f in progress_bar(image_list, leave=False):
             if verbose>0: print(f'Predicting {f.name}')
             ds = TileDataset([f], stats=self.stats, return_index=True, **ds_kwargs)
+            n_tiles += len(ds.tiles)
+            # Chunked like the tile outputs
+            shape = tuple(int(s) for s in ds.data_shapes[0])
+            chunks = tuple(min(o, s) for o, s in zip(ds.output_shape, shape))
+            if stream:
+                out = [self.g_smx.zeros(f.name, shape=(*shape, ds.c), chunks=(*chunks, ds.c), dtype='float32', overwrite=True)]
+                out += [g.zeros(f.name, shape=shape, chunks=chunks, dtype='float32', overwrite=True) if kwargs.get('uncertainty_estimates', True) else None
+                        for g in (self.g_std, self.g_eng)]
+                self.predict(ds, out=out, **kwargs)
+                self.skip_stats[f.name] = self.tile_stats
+                continue
             softmax, stdeviation, energy = self.predict(ds, **kwargs)
+            self.skip_stats[f.name] = self.tile_stats
 
             # Save to zarr
-            self.g_smx[f.name] = softmax
-            if stdeviation is not None: self.g_std[f.name] = stdeviation
-            if energy is not None: self.g_eng[f.name] = energy
+            self.g_smx.array(f.name, softmax, chunks=(*chunks, ds.c), overwrite=True)
+            if stdeviation is not None: self.g_std.array(f.name, stdeviation, chunks=chunks, overwrite=True)
+            if energy is not None: self.g_eng.array(f.name, energy, chunks=chunks, overwrite=True)
 
+        if verbose>0: self._print_skipped([f.name for f in image_list], n_tiles)
         return self.g_smx, self.g_std, self.g_eng
 
+    def _print_skipped(self, names, n_tiles):
+        "Prints the number of skipped background tiles (of `n_tiles`) and the time saved for the images `names`"
+        n_skipped = sum(self.skip_stats[n]['skipped_tiles'] for n in names)
+        if n_skipped>0:
+            time_saved = sum(self.skip_stats[n]['time_saved'] for n in names)
+            print(f'Skipped {n_skipped} of {n_tiles} background tiles in {len(names)} images (~{time_saved:.1f}s saved)')
+
 # Cell
+def _shutdown_workers(dls):
+    "Stops the persistent workers of the `PersistentDL`s in `dls`"
+    for dl in dls.loaders:
+        if isinstance(dl, PersistentDL): dl.shutdown()
+
+def _detached_recorder(recorder):
+    "Copy of `recorder` with the recorded values only, it does not keep the Learner (and its DataLoaders) alive"
+    rec = Recorder()
+    rec.__dict__.update({k: v for k, v in recorder.__dict__.items() if k!='learn'})
+    return rec
+
 class EnsembleLearner(GetAttr):
     _default = 'config'
     def __init__(self, image_dir='images', mask_dir=None, config=None, path=None, ensemble_dir=None, item_tfms=None,
@@ -335,7 +723,9 @@ class EnsembleLearner(GetAttr):
         self.models = {}
         self.recorder = {}
         self._set_splits()
-        self.ds = RandomTileDataset(self.files, label_fn=self.label_fn, stats=self.stats, verbose=0)
+        # Without masks, thumbnails are cached in the project folder
+        thumbnail_dir = None if self.label_fn else self.path/'.cache'/'thumbnails'
+        self.ds = RandomTileDataset(self.files, label_fn=self.label_fn, stats=self.stats, thumbnail_dir=thumbnail_dir, verbose=0)
         self.stats = stats or self.ds.stats
         self.in_channels = self.ds.get_data(max_n=1)[0].shape[-1]
         self.df_val, self.df_ens, self.df_model, self.ood = None,None,None,None
@@ -354,10 +744,11 @@ class EnsembleLearner(GetAttr):
     def pred_ds_kwargs(self):
         # Setting default shapes and padding
         ds_kwargs = self.add_ds_kwargs.copy()
-        ds_kwargs['tile_shape']= (self.tile_shape,)*2
+        ds_kwargs['tile_shape']= (self.tile_depth, self.tile_shape, self.tile_shape) if self.tile_depth>0 else (self.tile_shape,)*2
         ds_kwargs['n_classes']= self.c
         ds_kwargs['shift']= self.shift
         ds_kwargs['border_padding_factor']= self.border_padding_factor
+        ds_kwargs['fg_threshold']= self.fg_threshold if self.fg_threshold>0 else None
         return ds_kwargs
 
     @property
@@ -373,6 +764,7 @@ class EnsembleLearner(GetAttr):
         ds_kwargs['flip'] = self.flip
         ds_kwargs['albumentations_tfms'] = self._compose_albumentations(**self.albumentation_kwargs)
         ds_kwargs['sample_mult'] = self.sample_mult if self.sample_mult>0 else None
+        ds_kwargs['batch_aug'] = self.batch_aug
         return ds_kwargs
 
     @property
@@ -396,7 +788,15 @@ class EnsembleLearner(GetAttr):
             ds.append(TileDataset(files_val, label_fn=self.label_fn, **self.train_ds_kwargs))
         else:
             ds.append(ds[0])
-        dls = DataLoaders.from_dsets(*ds, bs=self.bs, pin_memory=True, **self.dl_kwargs)
+        # Workers reopen file and zarr handles of their dataset copies
+        dl_kwargs = {'dl_type': PersistentDL, 'persistent_workers': self.persistent_workers, 'wif': worker_init_fn, **self.dl_kwargs}
+        if self.shards>0:
+            # Epochs stream the pre-rendered tiles (shuffled by the ShardDataset)
+            ds[0] = ds[0].render_shards(n_samples=self.shards, buffer_size=self.shard_buffer, repeat=True)
+            dls = DataLoaders.from_dsets(*ds, bs=self.bs, pin_memory=True, shuffle=False, **dl_kwargs)
+        else:
+            dls = DataLoaders.from_dsets(*ds, bs=self.bs, pin_memory=True, **dl_kwargs)
+        for dl in dls.loaders: dl.fake_l.prefetch_factor = self.prefetch_factor
         if torch.cuda.is_available(): dls.cuda()
         return dls
 
@@ -417,19 +817,25 @@ class EnsembleLearner(GetAttr):
         model = self._create_model()
         files_train, files_val = self.splits[i]
         dls = self._get_dls(files_train, files_val)
-        self.learn = Learner(dls, model, metrics=self.metrics, wd=self.wd, loss_func=self.loss_fn, opt_func=_optim_dict[self.optim], cbs=self.cbs)
+        cbs = self.cbs + [dls.train_ds.batch_augmentation()] if self.batch_aug else self.cbs
+        if self.hard_examples:
+            if isinstance(dls.train_ds, RandomTileDataset): cbs = cbs + [dls.train_ds.hard_example_sampler()]
+            else: print('Hard example sampling is not available for pre-rendered shards')
+        self.learn = Learner(dls, model, metrics=self.metrics, wd=self.wd, loss_func=self.loss_fn, opt_func=_optim_dict[self.optim], cbs=cbs)
         self.learn.model_dir = self.ensemble_dir.parent/'.tmp'
         if self.mpt: self.learn.to_fp16()
         print(f'Starting training for {name.name}')
         epochs = calc_iterations(n_iter=n_iter,ds_length=len(dls.train_ds), bs=self.bs)
         #self.learn.fit_one_cycle(epochs, lr_max)
-        self.learn.fine_tune(epochs, base_lr=base_lr)
+        try: self.learn.fine_tune(epochs, base_lr=base_lr)
+        # Persistent workers do not outlive the fit
+        finally: _shutdown_workers(dls)
 
         print(f'Saving model at {name}')
         name.parent.mkdir(exist_ok=True, parents=True)
         save_smp_model(self.learn.model, self.arch, name, stats=self.stats)
         self.models[i]=name
-        self.recorder[i]=self.learn.recorder
+        self.recorder[i] = _detached_recorder(self.learn.recorder)
 
     def fit_ensemble(self, n_iter, skip=False, **kwargs):
         for i in range(1, self.n+1):
@@ -452,7 +858,7 @@ class EnsembleLearner(GetAttr):
             unc_path.mkdir(parents=True, exist_ok=True)
 
         for i, model_path in model_list.items():
-            ep = EnsemblePredict(models_paths=[model_path])
+            ep = EnsemblePredict(models_paths=[model_path], **self.inference_kwargs)
             _, files_val = self.splits[i]
             g_smx, g_std, g_eng = ep.predict_images(files_val, bs=self.bs, ds_kwargs=self.pred_ds_kwargs, **kwargs)
 
@@ -487,16 +893,18 @@ class EnsembleLearner(GetAttr):
             self.df_val.to_excel(export_dir/f'val_results.xlsx')
         return self.df_val
 
-    def show_valid_results(self, model_no=None, files=None, **kwargs):
+    def show_valid_results(self, model_no=None, files=None, thumbnail_size=1024, **kwargs):
         if self.df_val is None: self.get_valid_results(**kwargs)
         df = self.df_val
         if files is not None: df = df.set_index('file', drop=False).loc[files]
         if model_no is not None: df = df[df.model_no==model_no]
+        # Thumbnails (full resolution if `thumbnail_size` is None)
+        tc = self.ds.thumbnails
         for _, r in df.iterrows():
-            img = self.ds.get_data(r.image_path)[0][:]
-            msk = self.ds.get_data(r.image_path, mask=True)[0]
-            pred = np.argmax(zarr.load(r.softmax_path), axis=-1).astype('uint8')
-            std = zarr.load(r.uncertainty_path)
+            img = tc.read(r.image_path, 'image', thumbnail_size, read_fn=self.ds.read_img)
+            msk = tc.read(self.ds.preproc_dir/'labels'/r.file, 'label', thumbnail_size)
+            pred = tc.read(r.softmax_path, 'pred', thumbnail_size)
+            std = tc.read(r.uncertainty_path, 'unc', thumbnail_size)
             _d_model = f'Model {r.model_no}'
             if self.tta: plot_results(img, msk, pred, std, df=r, model=_d_model)
             else: plot_results(img, msk, pred, np.zeros_like(pred), df=r, model=_d_model)
@@ -512,7 +920,7 @@ class EnsembleLearner(GetAttr):
         print(self.models)
 
     def get_ensemble_results(self, files, zarr_store=None, export_dir=None, filetype='.png', **kwargs):
-        ep = EnsemblePredict(models_paths=self.models.values(), zarr_store=zarr_store)
+        ep = EnsemblePredict(models_paths=self.models.values(), zarr_store=zarr_store, **self.inference_kwargs)
         g_smx, g_std, g_eng = ep.predict_images(files, bs=self.bs, ds_kwargs=self.pred_ds_kwargs, **kwargs)
         chunk_store = g_smx.chunk_store.path
 
@@ -535,6 +943,7 @@ class EnsembleLearner(GetAttr):
                                 'softmax_path': f'{chunk_store}/{g_smx.path}/{f.name}',
                                 'uncertainty_path': f'{chunk_store}/{g_std.path}/{f.name}' if g_std is not None else None,
                                 'energy_path': f'{chunk_store}/{g_eng.path}/{f.name}'} if g_eng is not None else None)
+            if self.fg_threshold>0: df_tmp = pd.concat([df_tmp, pd.Series(ep.skip_stats[f.name])])
             res_list.append(df_tmp)
             if export_dir:
                 save_mask(pred, pred_path/f'{df_tmp.file}_{df_tmp.ensemble}_mask', filetype)
@@ -557,31 +966,35 @@ class EnsembleLearner(GetAttr):
             self.df_ens.loc[idx, 'iou'] = iou(msk, pred)
         return self.df_ens
 
-    def show_ensemble_results(self, files=None, model_no=None, unc=True, unc_metric=None):
+    def show_ensemble_results(self, files=None, model_no=None, unc=True, unc_metric=None, thumbnail_size=1024):
         assert self.df_ens is not None, "Please run `get_ensemble_results` first."
         if model_no is None: df = self.df_ens
         else: df = self.df_models[df_models.model_no==model_no]
         if files is not None: df = df.set_index('file', drop=False).loc[files]
+        # Thumbnails (full resolution if `thumbnail_size` is None)
+        tc = self.ds.thumbnails
         for _, r in df.iterrows():
             imgs = []
-            imgs.append(_read_img(r.image_path)[:])
+            imgs.append(tc.read(r.image_path, 'image', thumbnail_size))
             if 'iou' in r.index:
-                imgs.append(_read_msk(r.mask_path))
+                imgs.append(tc.read(r.mask_path, 'label', thumbnail_size))
                 hastarget=True
             else:
                 hastarget=False
-            imgs.append(np.argmax(zarr.load(r.softmax_path), axis=-1).astype('uint8'))
-            if unc: imgs.append(zarr.load(r.uncertainty_path))
+            imgs.append(tc.read(r.softmax_path, 'pred', thumbnail_size))
+            if unc: imgs.append(tc.read(r.uncertainty_path, 'unc', thumbnail_size))
             plot_results(*imgs, df=r, hastarget=hastarget, unc_metric=unc_metric)
 
     def lr_find(self, files=None, **kwargs):
         files = files or self.files
         dls = self._get_dls(files)
         model = self._create_model()
-        learn = Learner(dls, model, metrics=self.metrics, wd=self.wd, loss_func=self.loss_fn, opt_func=_optim_dict[self.optim])
+        cbs = [dls.train_ds.batch_augmentation()] if self.batch_aug else None
+        learn = Learner(dls, model, metrics=self.metrics, wd=self.wd, loss_func=self.loss_fn, opt_func=_optim_dict[self.optim], cbs=cbs)
         if self.mpt: learn.to_fp16()
-        sug_lrs = learn.lr_find(**kwargs)
-        return sug_lrs, learn.recorder
+        try: sug_lrs = learn.lr_find(**kwargs)
+        finally: _shutdown_workers(dls)
+        return sug_lrs, _detached_recorder(learn.recorder)
 
     def export_imagej_rois(self, output_folder='ImageJ_ROIs', **kwargs):
         assert self.df_ens is not None, "Please run prediction first."
@@ -599,6 +1012,8 @@ class EnsembleLearner(GetAttr):
             shutil.rmtree(self.path/'.tmp')
             print(f'Deleted temporary files from {self.path/".tmp"}')
         except: print(f'No temporary files to delete at {self.path/".tmp"}')
+        # Thumbnails of deleted results
+        self.ds.thumbnails.prune()
 
 # Cell
 add_docs(EnsembleLearner, "Meta class to train and predict model ensembles with `n` models",
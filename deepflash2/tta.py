@@ -12,16 +12,16 @@ from fastcore.foundation import store_attr
 
 # Cell
 def rot90(x, k=1):
-    "rotate batch of images by 90 degrees k times"
-    return torch.rot90(x, k, (2, 3))
+    "rotate batch of images (or volumes) by 90 degrees k times in the image plane"
+    return torch.rot90(x, k, (-2, -1))
 
 def hflip(x):
-    "flip batch of images horizontally"
-    return x.flip(3)
+    "flip batch of images (or volumes) horizontally"
+    return x.flip(-1)
 
 def vflip(x):
-    "flip batch of images vertically"
-    return x.flip(2)
+    "flip batch of images (or volumes) vertically"
+    return x.flip(-2)
 
 # Cell
 class BaseTransform: